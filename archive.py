@@ -0,0 +1,208 @@
+from __future__ import annotations
+
+import gzip
+import json
+import os
+import shutil
+from collections.abc import AsyncIterator, Iterator
+from datetime import datetime
+from typing import TYPE_CHECKING
+
+from kiota_abstractions.serialization import Parsable
+from kiota_serialization_json.json_parse_node import JsonParseNode
+from kiota_serialization_json.json_serialization_writer import JsonSerializationWriter
+
+from records import MessageRecord
+
+if TYPE_CHECKING:
+    from msgraph.generated.models.channel import Channel
+    from msgraph.generated.models.conversation_member import ConversationMember
+
+# Archive layout:
+#   index.json                          teams, their General channel and exported channels
+#   <team id>/<channel id>.jsonl.gz     one thread per line: {"message": ..., "replies": [...]}
+#   hosted-contents/                    inline images, see hosted_contents.py
+# Incremental exports append further gzip members to the channel files, so a thread can appear
+# more than once (edited messages).
+INDEX_FILE = "index.json"
+HOSTED_CONTENTS_DIR = "hosted-contents"
+
+COMPRESS_LEVEL = 6
+
+
+def serialize(value: Parsable) -> dict:
+    writer = JsonSerializationWriter()
+    writer.write_object_value(None, value)
+    return json.loads(writer.get_serialized_content())
+
+
+def parse(data: dict, factory: type[Parsable]) -> Parsable:
+    return JsonParseNode(data).get_object_value(factory)
+
+
+class ArchiveWriter:
+    path: str
+    index: dict
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        index_path = os.path.join(path, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path, encoding="utf-8") as index_file:
+                self.index = json.load(index_file)
+        else:
+            self.index = {"teams": {}}
+
+    def write_team(self, team_id: str, general_channel: Channel):
+        team = self.index["teams"].setdefault(team_id, {"channels": {}})
+        team["generalChannelId"] = general_channel.id
+        os.makedirs(os.path.join(self.path, team_id), exist_ok=True)
+        self._write_index()
+
+    async def write_channel(
+        self,
+        team_id: str,
+        channel: Channel,
+        members: list[ConversationMember],
+        threads: AsyncIterator[tuple[MessageRecord, list[MessageRecord]]],
+        append: bool = False,
+    ) -> tuple[int, int]:
+        file_name = f"{channel.id}.jsonl.gz".replace(":", "_")
+        message_count = reply_count = 0
+        # Written to a temporary file, so a channel in the index is always complete
+        channel_path = os.path.join(self.path, team_id, file_name)
+        entry = self.get_channel(team_id, channel.id)
+        append = append and entry is not None
+        with gzip.open(
+            channel_path + ".tmp", "wt", encoding="utf-8", compresslevel=COMPRESS_LEVEL
+        ) as channel_file:
+            async for message, replies in threads:
+                thread = {
+                    "message": message.to_json(),
+                    "replies": [reply.to_json() for reply in replies],
+                }
+                channel_file.write(json.dumps(thread, ensure_ascii=False) + "\n")
+                message_count += 1
+                reply_count += len(replies)
+        if append:
+            # Concatenated gzip members read back as one stream
+            with open(channel_path + ".tmp", "rb") as new_threads, open(
+                channel_path, "ab"
+            ) as channel_file:
+                shutil.copyfileobj(new_threads, channel_file)
+            os.remove(channel_path + ".tmp")
+        else:
+            os.replace(channel_path + ".tmp", channel_path)
+        self.index["teams"][team_id]["channels"][channel.id] = {
+            **(entry if append else {}),
+            "channel": serialize(channel),
+            "members": [serialize(member) for member in members],
+            "file": file_name,
+            "messages": message_count + (entry["messages"] if append else 0),
+            "replies": reply_count + (entry["replies"] if append else 0),
+        }
+        self._write_index()
+        return message_count, reply_count
+
+    def get_channel(self, team_id: str, channel_id: str) -> dict | None:
+        return self.index["teams"].get(team_id, {}).get("channels", {}).get(channel_id)
+
+    def record_sync_state(
+        self,
+        team_id: str,
+        channel_id: str,
+        synced_at: datetime | None = None,
+        delta_link: str | None = None,
+    ):
+        entry = self.index["teams"][team_id]["channels"][channel_id]
+        if synced_at is not None:
+            entry["syncedAt"] = synced_at.isoformat()
+        if delta_link is not None:
+            entry["deltaLink"] = delta_link
+        self._write_index()
+
+    def _write_index(self):
+        index_path = os.path.join(self.path, INDEX_FILE)
+        with open(index_path + ".tmp", "w", encoding="utf-8") as index_file:
+            json.dump(self.index, index_file, ensure_ascii=False, indent=1)
+        os.replace(index_path + ".tmp", index_path)
+
+
+class ArchiveReader:
+    # Offers the read methods of Graph used by export_team, so an archive can be imported like
+    # a live tenant
+    path: str
+    index: dict
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE), encoding="utf-8") as index_file:
+            self.index = json.load(index_file)
+
+    def _team(self, team_id: str) -> dict:
+        if team_id not in self.index["teams"]:
+            raise KeyError(f"Team {team_id} is not part of the archive {self.path}")
+        return self.index["teams"][team_id]
+
+    def count_team_messages(self, channel_names: dict[str, set[str]]) -> dict[str, int]:
+        # Messages and replies of the selected channels per team, as recorded by the export
+        return {
+            team_id: sum(
+                entry["messages"] + entry["replies"]
+                for entry in team["channels"].values()
+                if entry["channel"].get("displayName") in channel_names.get(team_id, ())
+            )
+            for team_id, team in self.index["teams"].items()
+        }
+
+    def count_messages(self, channel_names: dict[str, set[str]]) -> int:
+        return sum(self.count_team_messages(channel_names).values())
+
+    async def list_all_channels(self, team_id: str) -> list[Channel]:
+        from msgraph.generated.models.channel import Channel
+
+        return [
+            parse(entry["channel"], Channel) for entry in self._team(team_id)["channels"].values()
+        ]
+
+    async def get_primary_channel(self, team_id: str) -> Channel:
+        from msgraph.generated.models.channel import Channel
+
+        return Channel(id=self._team(team_id)["generalChannelId"])
+
+    async def list_channel_members(self, team_id: str, channel_id: str) -> list[ConversationMember]:
+        from msgraph.generated.models.conversation_member import ConversationMember
+
+        entry = self._team(team_id)["channels"][channel_id]
+        return [parse(member, ConversationMember) for member in entry["members"]]
+
+    async def iter_threads(
+        self, team_id: str, channel_id: str
+    ) -> AsyncIterator[tuple[MessageRecord, list[MessageRecord]]]:
+        entry = self._team(team_id)["channels"][channel_id]
+        with gzip.open(
+            os.path.join(self.path, team_id, entry["file"]), "rt", encoding="utf-8"
+        ) as channel_file:
+            for line in channel_file:
+                thread = json.loads(line)
+                yield (
+                    MessageRecord.from_json(thread["message"]),
+                    [MessageRecord.from_json(reply) for reply in thread["replies"]],
+                )
+
+    def iter_thread_ranges(
+        self, team_id: str, channel_id: str, range_threads: int
+    ) -> Iterator[list[bytes]]:
+        # The channel file split into ranges of consecutive threads, i.e. createdDateTime ranges
+        # in the order they were read. The lines are left undecoded, see transform_pool.py.
+        entry = self._team(team_id)["channels"][channel_id]
+        with gzip.open(os.path.join(self.path, team_id, entry["file"]), "rb") as channel_file:
+            lines = []
+            for line in channel_file:
+                lines.append(line)
+                if len(lines) == range_threads:
+                    yield lines
+                    lines = []
+            if lines:
+                yield lines
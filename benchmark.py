@@ -0,0 +1,339 @@
+import argparse
+import asyncio
+import configparser
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections.abc import Awaitable, Callable
+from typing import TypeVar
+
+import httpx
+from azure.core.credentials import AccessToken
+
+from archive import HOSTED_CONTENTS_DIR, ArchiveReader, ArchiveWriter
+from graph import Graph
+from hosted_contents import HostedContentStore
+from journal import MigrationJournal
+from main import archive_team, export_team
+from metrics import THROTTLED, TRANSFERRED_BYTES
+from mock_graph_server import NEW_TEAM_ID, OLD_SHAREPOINT, OLD_TEAM_ID, add_arguments, percentiles
+from pipeline import QUEUE_BYTES, QUEUE_MESSAGES, QueueBudget
+from throttling import TEAMS_LIMITS, RateLimiter
+from transform_pool import TransformPool
+
+T = TypeVar("T")
+
+# Measures export_team against mock_graph_server.py, which is started in a separate process so
+# its work doesn't count towards the migrator's time and memory. Example:
+#   python benchmark.py --channels 8 --messages 500 --latency 0.05 --throttle-rate 0.01
+
+UNTHROTTLED_LIMITS = {scope: (1e9, 1e9) for scope in TEAMS_LIMITS}
+
+
+class StaticCredential:
+    # The mock server accepts any token
+    async def get_token(self, *scopes, **kwargs) -> AccessToken:
+        return AccessToken("benchmark", int(time.time()) + 3600)
+
+    async def close(self):
+        pass
+
+
+class TimedRateLimiter(RateLimiter):
+    # Records the client side latency of every attempt, retries included
+    latencies: list[float]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+
+    async def run(
+        self,
+        request: Callable[[], Awaitable[T]],
+        team_id: str | None = None,
+        channel_id: str | None = None,
+        cost: float = 1,
+        idempotent: bool = False,
+    ) -> T:
+        async def timed_request() -> T:
+            started = time.perf_counter()
+            try:
+                return await request()
+            finally:
+                self.latencies.append(time.perf_counter() - started)
+
+        return await super().run(timed_request, team_id, channel_id, cost, idempotent)
+
+
+def mock_config(graph_url: str) -> configparser.SectionProxy:
+    config = configparser.ConfigParser()
+    config.read_dict(
+        {
+            "azure": {
+                "clientId": "benchmark",
+                "tenantId": "benchmark",
+                "graphUserScopes": "https://graph.microsoft.com/.default",
+                "graphUrl": graph_url,
+            }
+        }
+    )
+    return config["azure"]
+
+
+def start_server(args: argparse.Namespace) -> subprocess.Popen:
+    server_args = [
+        f"--port={args.port}",
+        f"--channels={args.channels}",
+        f"--messages={args.messages}",
+        f"--replies={args.replies}",
+        f"--reactions={args.reactions}",
+        f"--users={args.users}",
+        f"--page-size={args.page_size}",
+        f"--expanded-replies={args.expanded_replies}",
+        f"--latency={args.latency}",
+        f"--throttle-rate={args.throttle_rate}",
+        f"--retry-after={args.retry_after}",
+        f"--images={args.images}",
+        f"--image-variants={args.image_variants}",
+        f"--image-size={args.image_size}",
+    ]
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(__file__), "mock_graph_server.py")]
+        + server_args,
+        stdout=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            httpx.get(f"http://127.0.0.1:{args.port}/_stats").raise_for_status()
+            return server
+        except httpx.HTTPError:
+            if time.monotonic() > deadline or server.poll() is not None:
+                server.kill()
+                raise RuntimeError("Mock Graph server did not start")
+            time.sleep(0.1)
+
+
+async def run_benchmark(args: argparse.Namespace) -> dict:
+    graph_url = f"http://127.0.0.1:{args.port}/v1.0"
+    default_user = ["00000000-0000-0000-0000-000000000000", "John Doe"]
+    # Every other mock user is known in the new tenant, the others are posted as the default user
+    user_map = {
+        f"00000000-0000-0000-0000-{i:012d}": (f"User {i}", f"11111111-0000-0000-0000-{i:012d}")
+        for i in range(0, args.users, 2)
+    }
+    sharepoint_map = {
+        OLD_SHAREPOINT: "https://new-teams.sharepoint.com/sites/new-teams-site/Shared Documents"
+    }
+    limits = UNTHROTTLED_LIMITS if args.unthrottled else TEAMS_LIMITS
+    old_limiter = TimedRateLimiter(limits)
+    new_limiter = TimedRateLimiter(limits)
+    old_teams = Graph(
+        mock_config(graph_url),
+        True,
+        default_user,
+        user_map,
+        sharepoint_map,
+        old_limiter,
+        StaticCredential(),
+    )
+    new_teams = Graph(
+        mock_config(graph_url),
+        True,
+        default_user,
+        user_map,
+        sharepoint_map,
+        new_limiter,
+        StaticCredential(),
+    )
+    channel_names = {OLD_TEAM_ID: {"General"} | {f"Channel {i}" for i in range(1, args.channels)}}
+    with tempfile.TemporaryDirectory() as directory:
+        journal = MigrationJournal(os.path.join(directory, "journal.sqlite3"))
+        source = old_teams
+        hosted_content_store = HostedContentStore(
+            os.path.join(directory, HOSTED_CONTENTS_DIR), old_teams
+        )
+        transform_pool = None
+        if args.import_archive:
+            # Exported first and not measured, the import replays the archive
+            archive = ArchiveWriter(directory)
+            await archive_team(
+                old_teams,
+                OLD_TEAM_ID,
+                channel_names,
+                archive,
+                asyncio.Semaphore(args.concurrency),
+                hosted_content_store=hosted_content_store,
+            )
+            source = ArchiveReader(directory)
+            hosted_content_store = HostedContentStore(
+                os.path.join(directory, HOSTED_CONTENTS_DIR), None
+            )
+            if args.transform_workers != 0:
+                transform_pool = TransformPool(
+                    new_teams.transformer, hosted_content_store.contents, args.transform_workers
+                )
+        started = time.perf_counter()
+        cpu_started = time.process_time()
+        children_started = resource.getrusage(resource.RUSAGE_CHILDREN)
+        try:
+            await export_team(
+                source,
+                new_teams,
+                OLD_TEAM_ID,
+                NEW_TEAM_ID,
+                channel_names,
+                journal,
+                asyncio.Semaphore(args.concurrency),
+                thread_concurrency=args.thread_concurrency,
+                hosted_content_store=hosted_content_store,
+                queue_budget=QueueBudget(args.queue_messages, args.queue_bytes),
+                transform_pool=transform_pool,
+            )
+        finally:
+            elapsed = time.perf_counter() - started
+            cpu = time.process_time() - cpu_started
+            if transform_pool is not None:
+                # Waits for the worker processes, so their CPU time is accounted
+                transform_pool.close()
+            worker_cpu = None
+            if transform_pool is not None:
+                children = resource.getrusage(resource.RUSAGE_CHILDREN)
+                worker_cpu = (
+                    children.ru_utime
+                    + children.ru_stime
+                    - children_started.ru_utime
+                    - children_started.ru_stime
+                )
+            journal.close()
+            await old_teams.close()
+            await new_teams.close()
+    return {
+        "elapsed": elapsed,
+        "cpu": cpu,
+        "worker_cpu": worker_cpu,
+        "latencies": old_limiter.latencies + new_limiter.latencies,
+        "throttled": sum(
+            bucket.throttled
+            for limiter in (old_limiter, new_limiter)
+            for bucket in limiter.buckets.values()
+        ),
+    }
+
+
+def report(args: argparse.Namespace, result: dict, server_stats: dict):
+    expected_messages = args.channels * args.messages
+    expected_replies = expected_messages * args.replies
+    posted = server_stats["messages"] + server_stats["replies"]
+    client_latency = percentiles(result["latencies"]) if result["latencies"] else None
+    print(f"Migrated {server_stats['messages']} messages and {server_stats['replies']} replies")
+    if (server_stats["messages"], server_stats["replies"]) != (expected_messages, expected_replies):
+        print(f"  MISMATCH: expected {expected_messages} messages and {expected_replies} replies")
+    if args.images:
+        # Same numbering as MockGraph._message
+        expected_images = args.channels * sum(
+            1
+            for index in range(args.messages)
+            for number in range(index * 1000, index * 1000 + args.replies + 1)
+            if number % args.images == 0
+        )
+        print(f"Hosted contents:  {server_stats['hosted_contents']} posted")
+        if server_stats["hosted_contents"] != expected_images:
+            print(f"  MISMATCH: expected {expected_images} hosted contents")
+    print(f"Elapsed:          {result['elapsed']:.2f}s")
+    print(f"Throughput:       {posted / result['elapsed']:.1f} messages/s (replies included)")
+    # Close to 100% the event loop is the bottleneck (see --transform-workers), well below it
+    # the migrator waits for the network and the rate limits
+    print(
+        f"Client CPU:       {result['cpu']:.2f}s "
+        f"({result['cpu'] / result['elapsed']:.0%} of one core, "
+        f"{result['cpu'] / max(posted, 1) * 1000:.2f}ms per message)"
+    )
+    if result["worker_cpu"] is not None:
+        print(
+            f"Worker CPU:       {result['worker_cpu']:.2f}s "
+            f"({result['worker_cpu'] / result['elapsed']:.0%} of one core, "
+            f"{result['worker_cpu'] / max(posted, 1) * 1000:.2f}ms per message)"
+        )
+    print(f"Peak RSS:         {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+    print(f"Requests:         {sum(server_stats['requests'].values())}")
+    print(
+        f"429 responses:    {server_stats['throttled']} "
+        f"(client received {THROTTLED.total():.0f}, rate limiter retried {result['throttled']})"
+    )
+    print(
+        f"Transferred:      {TRANSFERRED_BYTES.get('sent') / 2**20:.1f} MiB sent, "
+        f"{TRANSFERRED_BYTES.get('received') / 2**20:.1f} MiB received"
+    )
+    if client_latency is not None:
+        print(
+            f"Client latency:   p50 {client_latency['p50'] * 1000:.1f}ms "
+            f"p99 {client_latency['p99'] * 1000:.1f}ms (rate limiter waits excluded)"
+        )
+    print("Server endpoints:")
+    for endpoint, count in sorted(server_stats["requests"].items()):
+        latency = server_stats["latency"][endpoint]
+        print(
+            f"  {endpoint:32} {count:7} requests  "
+            f"p50 {latency['p50'] * 1000:7.1f}ms  p99 {latency['p99'] * 1000:7.1f}ms"
+        )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Measure export_team against a local mock Graph server"
+    )
+    add_arguments(parser)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--concurrency", type=int, default=4, help="channels migrated at once")
+    parser.add_argument(
+        "--thread-concurrency", type=int, default=1, help="threads posted at once per channel"
+    )
+    parser.add_argument(
+        "--queue-messages",
+        type=int,
+        default=QUEUE_MESSAGES,
+        help="messages read but not yet posted, across all channels",
+    )
+    parser.add_argument(
+        "--queue-bytes", type=int, default=QUEUE_BYTES, help="estimated bytes of the same"
+    )
+    parser.add_argument(
+        "--unthrottled",
+        action="store_true",
+        help="disable the client side Teams rate limits to measure the migrator itself",
+    )
+    parser.add_argument(
+        "--import-archive",
+        action="store_true",
+        help="export the old team to an archive first (not measured) and measure its import",
+    )
+    parser.add_argument(
+        "--transform-workers",
+        type=int,
+        help="worker processes transforming the archive, default one per core, "
+        "0 to transform in the event loop",
+    )
+    parser.add_argument("--verbose", action="store_true", help="show the migration's log")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    # The migration's log is not part of the report
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.ERROR,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    server = start_server(args)
+    try:
+        result = asyncio.run(run_benchmark(args))
+        server_stats = httpx.get(f"http://127.0.0.1:{args.port}/_stats").json()
+    finally:
+        server.terminate()
+        server.wait()
+    report(args, result, server_stats)
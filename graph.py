@@ -1,48 +1,102 @@
-import requests
+from __future__ import annotations
+
+import asyncio
+import httpx
+import logging
 import os
 import re
+import time
+from collections.abc import AsyncIterator, Callable
 from configparser import SectionProxy
-from msal import PublicClientApplication
-from azure.identity import InteractiveBrowserCredential
-from azure.identity.aio import ClientSecretCredential
-from msgraph import GraphServiceClient
-from msgraph.generated.groups.groups_request_builder import GroupsRequestBuilder
-from msgraph.generated.teams.item.channels.item.messages.messages_request_builder import (
-    MessagesRequestBuilder,
-)
-from msgraph.generated.users.item.mail_folders.item.messages.messages_request_builder import (
-    MessagesRequestBuilder,
-)
-from msgraph.generated.models.directory_object import DirectoryObject
-from msgraph.generated.models.chat_message_attachment import ChatMessageAttachment
-from msgraph.generated.models.chat_message import ChatMessage
-from msgraph.generated.models.chat_message_reaction import ChatMessageReaction
-from msgraph.generated.models.item_body import ItemBody
-from msgraph.generated.models.body_type import BodyType
-from msgraph.generated.models.channel import Channel
-from msgraph.generated.models.group import Group
-from msgraph.generated.models.conversation_member import ConversationMember
-from msgraph.generated.models.chat_message_from_identity_set import (
-    ChatMessageFromIdentitySet,
-)
-
-from msgraph.generated.models.chat_message_mention import ChatMessageMention
-from msgraph.generated.teams.item.channels.channels_request_builder import (
-    ChannelsRequestBuilder,
-)
-from msgraph.generated.models.o_data_errors.o_data_error import ODataError
+from datetime import datetime
+from typing import TYPE_CHECKING
+from urllib.parse import urlencode
+from azure.core.credentials import AccessToken, TokenCredential
+from azure.core.credentials_async import AsyncTokenCredential
+from kiota_http.kiota_client_factory import DEFAULT_CONNECTION_TIMEOUT, DEFAULT_REQUEST_TIMEOUT
+from kiota_serialization_json.json_parse_node import JsonParseNode
+
+# The SDK's modules take most of the start-up time, they are imported where they are used. The
+# message path doesn't need them at all, see records.py.
+if TYPE_CHECKING:
+    from msgraph import GraphServiceClient
+    from msgraph.generated.models.channel import Channel
+    from msgraph.generated.models.chat_message import ChatMessage
+    from msgraph.generated.models.conversation_member import ConversationMember
+    from msgraph.generated.models.directory_object import DirectoryObject
+    from msgraph.generated.models.group import Group
+    from msgraph.generated.models.o_data_errors.o_data_error import ODataError
+    from msgraph.generated.models.user import User
+
+from metrics import QUEUED_PAGES, InstrumentedTransport
+from records import MessageRecord, PreparedMessage
+from throttling import RETRIED_STATUS_CODES, RateLimiter, retry_after
+from transform import HostedContent, MessageTransformer
+
+logger = logging.getLogger(__name__)
+
+GRAPH_URL = "https://graph.microsoft.com/v1.0"
+
+# https://learn.microsoft.com/en-us/graph/json-batching#batch-size-limitations
+BATCH_SIZE = 20
+
+# Replies inlined per message by $expand=replies, longer threads are fetched separately
+EXPANDED_REPLIES_LIMIT = 1000
+
+# Pages fetched ahead of the consumer by the iter_* methods
+PREFETCH_PAGES = 2
+
+# Properties of the users read to match them between the tenants, see users.py
+USER_PROPERTIES = ["id", "displayName", "userPrincipalName", "mail"]
+
+# Cached access tokens are renewed this many seconds before they expire
+TOKEN_REFRESH_MARGIN = 300
+
+# Name of the persistent token cache of the interactive login (OS keyring protected, e.g. DPAPI,
+# Keychain or libsecret), shared by every run on this machine
+TOKEN_CACHE_NAME = "teams-migrator"
+
+# The account signed in interactively, so later runs can pick its tokens from the cache. Holds no
+# secrets.
+AUTHENTICATION_RECORD_FILE = "authentication-record-{tenant_id}.json"
+
+
+class ThreadedCredential:
+    # The interactive credential of the old tenant is synchronous: a silent refresh does network
+    # I/O, a failed one opens the browser and waits for the sign-in. Both run in a thread, so
+    # the other teams and channels go on meanwhile (as far as they don't need a new token).
+    credential: TokenCredential
+
+    def __init__(self, credential: TokenCredential):
+        self.credential = credential
+
+    async def get_token(self, *scopes: str, **kwargs) -> AccessToken:
+        return await asyncio.to_thread(self.credential.get_token, *scopes, **kwargs)
+
+    async def close(self):
+        await asyncio.to_thread(self.credential.close)
 
 
 class Graph:
     settings: SectionProxy
-    app: PublicClientApplication
     graph_scopes: list[str]
-    credential: InteractiveBrowserCredential
-    client: GraphServiceClient
+    is_client_credential: bool
+    _credential: AsyncTokenCredential | None
+    _client: GraphServiceClient | None
     default_user: list[str]
     user_map: dict[str, str]
     sharepoint_map: dict[str, str]
     tenant_id: str
+    rate_limiter: RateLimiter
+    transformer: MessageTransformer
+    transport: httpx.AsyncBaseTransport
+    timeout: httpx.Timeout
+    http_client: httpx.AsyncClient
+    access_token: AccessToken | None
+    graph_url: str
+    # Per channel, the ids of its messages by createdDateTime, read by find_message
+    message_ids: dict[str, dict[datetime, str]]
+    message_ids_locks: dict[str, asyncio.Lock]
 
     def __init__(
         self,
@@ -51,43 +105,179 @@ class Graph:
         default_user: list[str],
         user_map: dict[str, str],
         sharepoint_map: dict[str, str],
+        rate_limiter: RateLimiter | None = None,
+        credential: AsyncTokenCredential | None = None,
     ):
         self.settings = config
-        client_id = self.settings["clientId"]
+        self.is_client_credential = is_client_credential
         self.tenant_id = self.settings["tenantId"]
         self.graph_scopes = self.settings["graphUserScopes"].split(" ")
+        # Overridden to run against a stand-in Graph server, see mock_graph_server.py
+        self.graph_url = self.settings.get("graphUrl", GRAPH_URL)
         self.default_user = default_user
         self.user_map = user_map
         self.sharepoint_map = sharepoint_map
+        # Shared by every call of this client, as the Teams limits apply per app and tenant
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.transformer = MessageTransformer(
+            self.tenant_id, default_user, user_map, sharepoint_map
+        )
+        # The SDK and the raw requests it can't express share one pooled keep-alive HTTP/2
+        # transport, which records the request metrics
+        self.timeout = httpx.Timeout(DEFAULT_REQUEST_TIMEOUT, connect=DEFAULT_CONNECTION_TIMEOUT)
+        self.transport = InstrumentedTransport(httpx.AsyncHTTPTransport(http2=True))
+        self.http_client = httpx.AsyncClient(timeout=self.timeout, transport=self.transport)
+        self.access_token = None
+        self.access_token_lock = asyncio.Lock()
+        self.message_ids = {}
+        self.message_ids_locks = {}
+        self._credential = credential
+        self._client = None
+
+    @property
+    def credential(self) -> AsyncTokenCredential:
+        # Built on first use, so runs that don't read this tenant (e.g. imports of an archive)
+        # neither sign in nor import azure.identity
+        if self._credential is None:
+            if self.is_client_credential:
+                from azure.identity.aio import ClientSecretCredential
+
+                self._credential = ClientSecretCredential(
+                    self.tenant_id,
+                    self.settings["clientId"],
+                    os.environ.get("CLIENT_SECRET"),
+                )
+            else:
+                self._credential = ThreadedCredential(self._interactive_credential())
+        return self._credential
+
+    def _interactive_credential(self) -> TokenCredential:
+        # https://learn.microsoft.com/en-us/azure/developer/python/sdk/authentication/local-development-user-accounts#persist-the-token-cache
+        # Only the first run signs in through the browser, later runs authenticate silently with
+        # the refresh token of the persistent cache until it expires
+        from azure.identity import (
+            AuthenticationRecord,
+            InteractiveBrowserCredential,
+            TokenCachePersistenceOptions,
+        )
 
-        if is_client_credential:
-            self.credential = ClientSecretCredential(
-                self.tenant_id,
-                client_id,
-                os.environ.get("CLIENT_SECRET"),
+        record_path = self.settings.get(
+            "authenticationRecord", AUTHENTICATION_RECORD_FILE.format(tenant_id=self.tenant_id)
+        )
+        record = None
+        if os.path.exists(record_path):
+            with open(record_path, encoding="utf-8") as record_file:
+                record = AuthenticationRecord.deserialize(record_file.read())
+        credential = InteractiveBrowserCredential(
+            client_id=self.settings["clientId"],
+            tenant_id=self.tenant_id,
+            authentication_record=record,
+            # Hosts without a keyring (e.g. headless Linux) may opt into a plain file
+            cache_persistence_options=TokenCachePersistenceOptions(
+                name=TOKEN_CACHE_NAME,
+                allow_unencrypted_storage=self.settings.getboolean(
+                    "allowUnencryptedTokenCache", False
+                ),
+            ),
+        )
+        if record is None:
+            record = credential.authenticate(scopes=self.graph_scopes)
+            with open(record_path + ".tmp", "w", encoding="utf-8") as record_file:
+                record_file.write(record.serialize())
+            os.replace(record_path + ".tmp", record_path)
+            logger.info("Signed in as %s, remembered in %s", record.username, record_path)
+        return credential
+
+    @property
+    def client(self) -> GraphServiceClient:
+        # Built on first use, the SDK is imported with it
+        if self._client is None:
+            from kiota_authentication_azure.azure_identity_authentication_provider import (
+                AzureIdentityAuthenticationProvider,
             )
-            self.client = GraphServiceClient(credentials=self.credential, scopes=self.graph_scopes)
-        else:
-            self.app = PublicClientApplication(
-                client_id, authority=f"https://login.microsoftonline.com/{self.tenant_id}"
+            from msgraph import GraphRequestAdapter, GraphServiceClient
+            from kiota_http.kiota_client_factory import KiotaClientFactory
+            from kiota_http.middleware import RetryHandler
+            from msgraph.graph_request_adapter import options as graph_client_options
+            from msgraph_core import GraphClientFactory
+            from msgraph_core.middleware import GraphTelemetryHandler
+
+            # The default middleware without the RetryHandler: 429/503/504 reach the rate
+            # limiter, which slows down the bucket concerned before it retries
+            middleware = [
+                handler
+                for handler in KiotaClientFactory.get_default_middleware(graph_client_options)
+                if not isinstance(handler, RetryHandler)
+            ]
+            middleware.append(GraphTelemetryHandler())
+            # The SDK and the raw requests share one pooled keep-alive HTTP/2 transport, which
+            # records the request metrics
+            sdk_client = GraphClientFactory.create_with_custom_middleware(
+                middleware,
+                client=httpx.AsyncClient(timeout=self.timeout, transport=self.transport),
             )
-            self.credential = InteractiveBrowserCredential(
-                client_id=client_id, tenant_id=self.tenant_id
+            self._client = GraphServiceClient(
+                request_adapter=GraphRequestAdapter(
+                    AzureIdentityAuthenticationProvider(self.credential, scopes=self.graph_scopes),
+                    client=sdk_client,
+                )
             )
-            self.client = GraphServiceClient(self.credential, self.graph_scopes)
+            self._client.request_adapter.base_url = self.graph_url
+        return self._client
 
     async def get_user_token(self):
-        result = self.credential.get_token("User.Read")
+        result = await self.credential.get_token("User.Read")
         return result.token
 
     # https://learn.microsoft.com/en-us/graph/api/group-list-members?view=graph-rest-1.0&tabs=python
     async def list_group_membership(self, group_id: str) -> list[DirectoryObject]:
-        members = await self.client.groups.by_group_id(group_id).members.get()
+        members = await self.rate_limiter.run(
+            lambda: self.client.groups.by_group_id(group_id).members.get(), idempotent=True
+        )
         return members.value
 
+    # https://learn.microsoft.com/en-us/graph/api/user-delta?view=graph-rest-1.0&tabs=python
+    async def iter_users_delta(
+        self, delta_link: str | None, save_delta_link: Callable[[str], None]
+    ) -> AsyncIterator[User]:
+        # Every user on the first run, afterwards only the changed and removed ones (marked by
+        # "@removed" in additional_data). The delta link is handed to save_delta_link after the
+        # last page.
+        from msgraph.generated.users.delta.delta_request_builder import (
+            DeltaRequestBuilder as UsersDeltaRequestBuilder,
+        )
+
+        delta = self.client.users.delta
+        request_configuration = UsersDeltaRequestBuilder.DeltaRequestBuilderGetRequestConfiguration(
+            query_parameters=UsersDeltaRequestBuilder.DeltaRequestBuilderGetQueryParameters(
+                select=USER_PROPERTIES,
+            ),
+        )
+        page = await self.rate_limiter.run(
+            lambda: (
+                delta.with_url(delta_link).get()
+                if delta_link
+                else delta.get(request_configuration=request_configuration)
+            ),
+            idempotent=True,
+        )
+        while True:
+            for user in page.value:
+                yield user
+            next_link = page.odata_next_link
+            if not next_link:
+                break
+            page = await self.rate_limiter.run(
+                lambda: delta.with_url(next_link).get(), idempotent=True
+            )
+        if page.odata_delta_link:
+            save_delta_link(page.odata_delta_link)
+
     # https://learn.microsoft.com/en-us/graph/teams-list-all-teams
     # https://learn.microsoft.com/en-us/graph/api/group-list?view=graph-rest-1.0&tabs=python
     async def list_teams(self) -> list[Group]:
+        from msgraph.generated.groups.groups_request_builder import GroupsRequestBuilder
+
         query_params = GroupsRequestBuilder.GroupsRequestBuilderGetQueryParameters(
             filter="resourceProvisioningOptions/Any(x:x eq 'Team')",
         )
@@ -95,7 +285,10 @@ class Graph:
             query_parameters=query_params,
         )
         # request_configuration.headers.add("ConsistencyLevel", "eventual")
-        teams = await self.client.groups.get(request_configuration=request_configuration)
+        teams = await self.rate_limiter.run(
+            lambda: self.client.groups.get(request_configuration=request_configuration),
+            idempotent=True,
+        )
         return teams.value
 
     # https://learn.microsoft.com/en-us/graph/api/team-post?view=graph-rest-beta&tabs=python&preserve-view=true
@@ -115,7 +308,7 @@ class Graph:
         #     },
         # )
         # teams = await self.client.teams.post(request_body)
-        url = "https://graph.microsoft.com/v1.0/teams/"
+        url = f"{self.graph_url}/teams/"
         json_body = {
             "@microsoft.graph.teamCreationMode": "migration",
             "template@odata.bind": "https://graph.microsoft.com/v1.0/teamsTemplates('standard')",
@@ -123,28 +316,34 @@ class Graph:
             "description": description,
             "createdDateTime": "2015-01-01T11:11:11.000Z",
         }
-        access = await self.credential.get_token(self.graph_scopes[0])
-        headers = {
-            "Authorization": "Bearer " + access.token,
-            "Content-Type": "application/json",
-        }
-        response = requests.post(url, headers=headers, json=json_body)
+        response = await self.rate_limiter.run(lambda: self._post(url, json_body))
         if response.status_code == 202:
-            print("Teams created successfully.")
+            logger.info("Teams created successfully.")
         else:
-            print("Error creating teams. Status code:", response.status_code)
-            print("Response:", response.text)
+            logger.error(
+                "Error creating teams. Status code: %s Response: %s",
+                response.status_code,
+                response.text,
+            )
         pattern = r"'([a-f0-9-]+)'"
         match = re.search(pattern, response.headers.get("Content-Location"))
         return match.group(1)
 
     # https://learn.microsoft.com/en-us/graph/api/channel-list?view=graph-rest-1.0&tabs=python
     async def list_all_channels(self, team_id: str) -> list[Channel]:
-        channels = await self.client.teams.by_team_id(team_id).channels.get()
+        channels = await self.rate_limiter.run(
+            lambda: self.client.teams.by_team_id(team_id).channels.get(),
+            team_id=team_id,
+            idempotent=True,
+        )
         return channels.value
 
     # https://learn.microsoft.com/en-us/graph/api/channel-list?view=graph-rest-1.0&tabs=python
     async def get_channel(self, team_id: str, channel_name: str) -> Channel | None:
+        from msgraph.generated.teams.item.channels.channels_request_builder import (
+            ChannelsRequestBuilder,
+        )
+
         query_params = ChannelsRequestBuilder.ChannelsRequestBuilderGetQueryParameters(
             filter=f"displayName eq '{channel_name}'",
         )
@@ -153,12 +352,25 @@ class Graph:
                 query_parameters=query_params,
             )
         )
-        result = await self.client.teams.by_team_id(team_id).channels.get(
-            request_configuration=request_configuration
+        result = await self.rate_limiter.run(
+            lambda: self.client.teams.by_team_id(team_id).channels.get(
+                request_configuration=request_configuration
+            ),
+            team_id=team_id,
+            idempotent=True,
         )
         return result.value[0] if len(result.value) > 0 else None
 
-    async def create_channel(self, team_id: str, old_channel: Channel) -> Channel:
+    # https://learn.microsoft.com/en-us/graph/api/team-get-primarychannel?view=graph-rest-1.0&tabs=python
+    async def get_primary_channel(self, team_id: str) -> Channel:
+        return await self.rate_limiter.run(
+            lambda: self.client.teams.by_team_id(team_id).primary_channel.get(),
+            team_id=team_id,
+            idempotent=True,
+        )
+
+    # https://learn.microsoft.com/en-us/graph/api/channel-post?view=graph-rest-1.0&tabs=http#example-4-create-a-channel-in-migration-mode
+    async def create_channel(self, team_id: str, old_channel: Channel) -> Channel | None:
         # Using the SDK does not work, as the additional_data field does not get parsed into the request.
         # request_body = Channel(
         #     display_name=old_channel.display_name,
@@ -170,7 +382,7 @@ class Graph:
         # )
         # new_channel = await self.client.teams.by_team_id(team_id).channels.post(request_body)
         # return new_channel
-        url = f"https://graph.microsoft.com/v1.0/teams/{team_id}/channels"
+        url = f"{self.graph_url}/teams/{team_id}/channels"
         json_body = {
             "@microsoft.graph.channelCreationMode": "migration",
             "displayName": old_channel.display_name,
@@ -179,26 +391,29 @@ class Graph:
             "createdDateTime": old_channel.created_date_time.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
             + "Z",
         }
-        bearer_token = await self.credential.get_token(self.graph_scopes[0])
-        headers = {
-            "Authorization": "Bearer " + bearer_token.token,
-            "Content-Type": "application/json",
-        }
-        response = requests.post(url, headers=headers, json=json_body)
+        response = await self.rate_limiter.run(lambda: self._post(url, json_body), team_id=team_id)
         if response.status_code == 201:
-            print("Channel created successfully.")
-        else:
-            print("Error creating channel. Status code:", response.status_code)
-            print("Response:", response.text)
+            logger.info("Channel %s created successfully.", old_channel.display_name)
+            # The response is the new channel, no need to look it up
+            from msgraph.generated.models.channel import Channel
 
+            return JsonParseNode(response.json()).get_object_value(Channel)
+        logger.error(
+            "Error creating channel. Status code: %s Response: %s",
+            response.status_code,
+            response.text,
+        )
+        # E.g. created in the meantime by another run
         return await self.get_channel(team_id, old_channel.display_name)
 
     # https://learn.microsoft.com/en-us/graph/api/channel-list-members?view=graph-rest-1.0&tabs=python
     async def list_channel_members(self, team_id: str, channel_id: str) -> list[ConversationMember]:
-        members = (
-            await self.client.teams.by_team_id(team_id)
+        members = await self.rate_limiter.run(
+            lambda: self.client.teams.by_team_id(team_id)
             .channels.by_channel_id(channel_id)
-            .members.get()
+            .members.get(),
+            channel_id=channel_id,
+            idempotent=True,
         )
         return members.value
 
@@ -213,26 +428,28 @@ class Graph:
         #     },
         # )
         # await self.client.teams.by_team_id(team_id).members.post(request_body)
-        url = f"https://graph.microsoft.com/v1.0/teams/{team_id}/members"
+        url = f"{self.graph_url}/teams/{team_id}/members"
         json_body = {
             "@odata.type": "#microsoft.graph.aadUserConversationMember",
             "roles": ["owner"],
             "user@odata.bind": f"https://graph.microsoft.com/beta/users/{user_id}",
         }
-        bearer_token = await self.credential.get_token(self.graph_scopes[0])
-        headers = {
-            "Authorization": "Bearer " + bearer_token.token,
-            "Content-Type": "application/json",
-        }
-        response = requests.post(url, headers=headers, json=json_body)
+        response = await self.rate_limiter.run(lambda: self._post(url, json_body), team_id=team_id)
         if response.status_code == 201:
-            print("Member added successfully.")
+            logger.info("Member added successfully.")
         else:
-            print("Error adding member to teams. Status code:", response.status_code)
-            print("Response:", response.text)
+            logger.error(
+                "Error adding member to teams. Status code: %s Response: %s",
+                response.status_code,
+                response.text,
+            )
 
     # https://learn.microsoft.com/en-us/graph/api/channel-list-messages?view=graph-rest-1.0&tabs=python
     async def list_messages(self, team_id: str, channel_id: str) -> list[ChatMessage]:
+        from msgraph.generated.teams.item.channels.item.messages.messages_request_builder import (
+            MessagesRequestBuilder,
+        )
+
         query_params = MessagesRequestBuilder.MessagesRequestBuilderGetQueryParameters(
             top=50,
         )
@@ -241,198 +458,401 @@ class Graph:
                 query_parameters=query_params,
             )
         )
-        messages = (
-            await self.client.teams.by_team_id(team_id)
+        messages = await self.rate_limiter.run(
+            lambda: self.client.teams.by_team_id(team_id)
             .channels.by_channel_id(channel_id)
-            .messages.get(request_configuration=request_configuration)
+            .messages.get(request_configuration=request_configuration),
+            channel_id=channel_id,
+            idempotent=True,
         )
         chat_messages = messages.value
         next_link = messages.odata_next_link
         while next_link:
-            messages = (
-                await self.client.teams.by_team_id(team_id)
+            messages = await self.rate_limiter.run(
+                lambda: self.client.teams.by_team_id(team_id)
                 .channels.by_channel_id(channel_id)
                 .messages.with_url(next_link)
-                .get()
+                .get(),
+                channel_id=channel_id,
+                idempotent=True,
             )
             next_link = messages.odata_next_link
             chat_messages.extend(messages.value)
         return [msg for msg in chat_messages if msg.message_type == "message"]
 
+    async def iter_messages(
+        self, team_id: str, channel_id: str, prefetch: int = PREFETCH_PAGES
+    ) -> AsyncIterator[MessageRecord]:
+        url = f"{self.graph_url}/teams/{team_id}/channels/{channel_id}/messages?" + urlencode(
+            {"$top": 50}
+        )
+        async for page in self._iter_pages(url, channel_id, prefetch):
+            for message in page["value"]:
+                if is_posted_message(message):
+                    yield MessageRecord.from_json(message)
+
+    # https://learn.microsoft.com/en-us/graph/api/channel-list-messages?view=graph-rest-1.0&tabs=python#example-2-request-with-top-query-option-and-expand-query-option-on-replies
+    async def iter_threads(
+        self, team_id: str, channel_id: str, prefetch: int = PREFETCH_PAGES
+    ) -> AsyncIterator[tuple[MessageRecord, list[MessageRecord]]]:
+        url = f"{self.graph_url}/teams/{team_id}/channels/{channel_id}/messages?" + urlencode(
+            {"$top": 50, "$expand": "replies"}
+        )
+        async for page in self._iter_pages(url, channel_id, prefetch):
+            messages_of_page = [message for message in page["value"] if is_posted_message(message)]
+            # Threads longer than the expansion are re-read in JSON batches instead of one GET each
+            truncated = [
+                message["id"]
+                for message in messages_of_page
+                if "replies@odata.nextLink" in message
+                or len(message.get("replies") or []) >= EXPANDED_REPLIES_LIMIT
+            ]
+            batched_replies = (
+                await self.batch_list_replies(team_id, channel_id, truncated) if truncated else {}
+            )
+            for message in messages_of_page:
+                replies = batched_replies.get(message["id"])
+                if replies is None:
+                    replies = [
+                        MessageRecord.from_json(reply)
+                        for reply in message.get("replies") or []
+                        if reply.get("deletedDateTime") is None
+                    ]
+                yield MessageRecord.from_json(message), replies
+
+    # https://learn.microsoft.com/en-us/graph/api/chatmessage-delta?view=graph-rest-1.0&tabs=python
+    async def iter_delta_threads(
+        self,
+        team_id: str,
+        channel_id: str,
+        delta_link: str | None,
+        modified_since: datetime | None,
+        save_delta_link: Callable[[str], None],
+        prefetch: int = PREFETCH_PAGES,
+    ) -> AsyncIterator[tuple[MessageRecord, list[MessageRecord]]]:
+        # Only new or edited root messages are returned, their replies are read in JSON batches.
+        # The delta link is handed to save_delta_link once every thread has been consumed.
+        # A stored delta link continues the previous sync, otherwise the query starts at
+        # modified_since (or at the beginning of the channel)
+        query = {"$top": 50}
+        if modified_since:
+            query["$filter"] = (
+                f"lastModifiedDateTime gt {modified_since.strftime('%Y-%m-%dT%H:%M:%SZ')}"
+            )
+        url = delta_link or (
+            f"{self.graph_url}/teams/{team_id}/channels/{channel_id}/messages/delta?"
+            + urlencode(query)
+        )
+        async for page in self._iter_pages(url, channel_id, prefetch):
+            messages_of_page = [message for message in page["value"] if is_posted_message(message)]
+            replies = (
+                await self.batch_list_replies(
+                    team_id, channel_id, [message["id"] for message in messages_of_page]
+                )
+                if messages_of_page
+                else {}
+            )
+            for message in messages_of_page:
+                yield MessageRecord.from_json(message), replies[message["id"]]
+            if page.get("@odata.deltaLink"):
+                save_delta_link(page["@odata.deltaLink"])
+
+    # https://learn.microsoft.com/en-us/graph/json-batching
+    async def batch_list_replies(
+        self, team_id: str, channel_id: str, chat_message_ids: list[str]
+    ) -> dict[str, list[MessageRecord]]:
+        # Deleted replies are left out
+        replies = {chat_message_id: [] for chat_message_id in chat_message_ids}
+        pending = {
+            chat_message_id: f"/teams/{team_id}/channels/{channel_id}/messages/{chat_message_id}/replies"
+            for chat_message_id in chat_message_ids
+        }
+        # Retries of the pending request per message, limited like those of RateLimiter.run
+        attempts = dict.fromkeys(chat_message_ids, 0)
+        while pending:
+            batch = list(pending.items())[:BATCH_SIZE]
+            json_body = {
+                "requests": [
+                    {"id": chat_message_id, "method": "GET", "url": url}
+                    for chat_message_id, url in batch
+                ]
+            }
+            response = await self.rate_limiter.run(
+                lambda: self._post(f"{self.graph_url}/$batch", json_body),
+                channel_id=channel_id,
+                cost=len(batch),
+                idempotent=True,
+            )
+            if response.status_code != 200:
+                raise odata_error(response.status_code, error_body(response))
+            throttled_for = 0.0
+            for result in response.json()["responses"]:
+                chat_message_id = result["id"]
+                if (
+                    result["status"] in RETRIED_STATUS_CODES
+                    and attempts[chat_message_id] < self.rate_limiter.max_retries
+                ):
+                    # Stays pending and is retried with the next batch
+                    throttled_for = max(
+                        throttled_for,
+                        retry_after(result.get("headers"), attempts[chat_message_id]),
+                    )
+                    attempts[chat_message_id] += 1
+                    continue
+                if result["status"] != 200:
+                    raise odata_error(result["status"], result.get("body"))
+                replies[chat_message_id].extend(
+                    MessageRecord.from_json(reply)
+                    for reply in result["body"]["value"]
+                    if reply.get("deletedDateTime") is None
+                )
+                attempts[chat_message_id] = 0
+                next_link = result["body"].get("@odata.nextLink")
+                if next_link:
+                    pending[chat_message_id] = next_link.removeprefix(self.graph_url)
+                else:
+                    del pending[chat_message_id]
+            if throttled_for:
+                self.rate_limiter.throttle(throttled_for, channel_id=channel_id)
+        return replies
+
+    async def find_message(
+        self, team_id: str, channel_id: str, created_date_time: datetime
+    ) -> str | None:
+        # Imported messages keep their createdDateTime, which identifies them in the new channel.
+        # A resumed run looks up every message sent but not recorded, so the channel is read
+        # once and its message ids kept. They are read again for a message posted since.
+        async with self.message_ids_locks.setdefault(channel_id, asyncio.Lock()):
+            message_ids = self.message_ids.get(channel_id)
+            if message_ids is None or created_date_time not in message_ids:
+                message_ids = self.message_ids[channel_id] = {
+                    message.created_date_time: message.id
+                    async for message in self.iter_messages(team_id, channel_id)
+                }
+            return message_ids.get(created_date_time)
+
+    def forget_messages(self, channel_id: str):
+        # Drops what find_message kept of a channel
+        self.message_ids.pop(channel_id, None)
+        self.message_ids_locks.pop(channel_id, None)
+
     # https://learn.microsoft.com/en-us/graph/api/channel-post-messages?view=graph-rest-1.0&tabs=python
     async def send_message(
-        self, team_id: str, channel_id: str, old_msg: ChatMessage
-    ) -> ChatMessage:
-        request_body = ChatMessage(
-            message_type=old_msg.message_type,
-            created_date_time=old_msg.created_date_time,
-            subject=old_msg.subject,
-            summary=old_msg.summary,
-            from_=old_msg.from_,
-            body=old_msg.body,
-            attachments=self.map_attachments(old_msg.attachments),
-            mentions=old_msg.mentions,
-        )
-        self.map_user(request_body.from_)
-        self.map_mentions_user(request_body.mentions)
-        self.replace_inexistant_users(request_body)
-        # It is not yet possible to import reactions...
-        # for i in range(len(request_body.reactions)):
-        #    request_body.reactions[i].user = self.map_user(request_body.reactions[i].user)
-        self.add_reaction_to_body(request_body.body, old_msg.reactions)
-        request_body.body.content = request_body.body.content.replace("&nbsp;", " ")
-        # Reformat emojis
-        if "<emoji id=" in request_body.body.content:
-            request_body.body.content = request_body.body.content.replace('" title=""></emoji>', "")
-            pattern = r'<emoji id="[a-zA-Z]+" alt="'
-            request_body.body.content = re.sub(pattern, "", request_body.body.content)
-        print("reply requestbody constructed: %s", request_body)
-        try:
-            return (
-                await self.client.teams.by_team_id(team_id)
-                .channels.by_channel_id(channel_id)
-                .messages.post(request_body)
-            )
-        except ODataError as odata_error:
-            if odata_error.response_status_code == 409:
-                return ChatMessage(id="Msg already exists")
-            raise odata_error
+        self,
+        team_id: str,
+        channel_id: str,
+        old_msg: MessageRecord | PreparedMessage,
+        hosted_contents: dict[str, HostedContent] | None = None,
+    ) -> str | None:
+        # Returns the id of the new message, None if it had been imported before
+        request_body = self.request_body(old_msg, hosted_contents)
+        logger.debug("message request body constructed: %s", request_body)
+        url = f"{self.graph_url}/teams/{team_id}/channels/{channel_id}/messages"
+        return await self._send(url, request_body, channel_id)
 
     # https://learn.microsoft.com/en-us/graph/api/chatmessage-list-replies?view=graph-rest-1.0&tabs=python
     async def list_replies(
         self, team_id: str, channel_id: str, chat_message_id: str
     ) -> list[ChatMessage]:
-        replies = (
-            await self.client.teams.by_team_id(team_id)
+        replies = await self.rate_limiter.run(
+            lambda: self.client.teams.by_team_id(team_id)
             .channels.by_channel_id(channel_id)
             .messages.by_chat_message_id(chat_message_id)
-            .replies.get()
+            .replies.get(),
+            channel_id=channel_id,
+            idempotent=True,
         )
         reply_messages = replies.value
         next_link = replies.odata_next_link
         while next_link:
-            replies = (
-                await self.client.teams.by_team_id(team_id)
+            replies = await self.rate_limiter.run(
+                lambda: self.client.teams.by_team_id(team_id)
                 .channels.by_channel_id(channel_id)
                 .messages.by_chat_message_id(chat_message_id)
                 .replies.with_url(next_link)
-                .get()
+                .get(),
+                channel_id=channel_id,
+                idempotent=True,
             )
             next_link = replies.odata_next_link
             reply_messages.extend(replies.value)
         return reply_messages
 
+    async def iter_replies(
+        self, team_id: str, channel_id: str, chat_message_id: str, prefetch: int = PREFETCH_PAGES
+    ) -> AsyncIterator[MessageRecord]:
+        url = (
+            f"{self.graph_url}/teams/{team_id}/channels/{channel_id}"
+            f"/messages/{chat_message_id}/replies"
+        )
+        async for page in self._iter_pages(url, channel_id, prefetch):
+            for reply in page["value"]:
+                if reply.get("deletedDateTime") is None:
+                    yield MessageRecord.from_json(reply)
+
     # https://learn.microsoft.com/en-us/graph/api/chatmessage-post-replies?view=graph-rest-1.0&tabs=python
     async def send_reply(
-        self, team_id: str, channel_id: str, chat_message_id: str, old_reply: ChatMessage
-    ) -> ChatMessage:
-        request_body = ChatMessage(
-            message_type=old_reply.message_type,
-            created_date_time=old_reply.created_date_time,
-            subject=old_reply.subject,
-            summary=old_reply.summary,
-            from_=old_reply.from_,
-            body=old_reply.body,
-            attachments=self.map_attachments(old_reply.attachments),
-            mentions=old_reply.mentions,
-        )
-        self.map_user(request_body.from_)
-        self.map_mentions_user(request_body.mentions)
-        self.replace_inexistant_users(request_body)
-        # It is not yet possible to import reactions...
-        # for i in range(len(request_body.reactions)):
-        #    request_body.reactions[i].user = self.map_user(request_body.reactions[i].user)
-        self.add_reaction_to_body(request_body.body, old_reply.reactions)
-        request_body.body.content = request_body.body.content.replace("&nbsp;", " ")
-        # Reformat emojis
-        if "<emoji id=" in request_body.body.content:
-            print("working on emoji regex")
-            request_body.body.content = request_body.body.content.replace('" title=""></emoji>', "")
-            pattern = r'<emoji id="[a-zA-Z]+" alt="'
-            request_body.body.content = re.sub(pattern, "", request_body.body.content)
-        print("reply requestbody constructed: %s", request_body)
-        return (
-            await self.client.teams.by_team_id(team_id)
-            .channels.by_channel_id(channel_id)
-            .messages.by_chat_message_id(chat_message_id)
-            .replies.post(request_body)
+        self,
+        team_id: str,
+        channel_id: str,
+        chat_message_id: str,
+        old_reply: MessageRecord | PreparedMessage,
+        hosted_contents: dict[str, HostedContent] | None = None,
+    ) -> str | None:
+        # Returns the id of the new reply, None if it had been imported before
+        request_body = self.request_body(old_reply, hosted_contents)
+        logger.debug("reply request body constructed: %s", request_body)
+        url = (
+            f"{self.graph_url}/teams/{team_id}/channels/{channel_id}"
+            f"/messages/{chat_message_id}/replies"
         )
+        return await self._send(url, request_body, channel_id)
+
+    def request_body(
+        self,
+        old_msg: MessageRecord | PreparedMessage,
+        hosted_contents: dict[str, HostedContent] | None,
+    ) -> dict | bytes:
+        # Prepared messages were transformed and encoded by a worker process
+        if isinstance(old_msg, PreparedMessage):
+            return old_msg.request_body
+        return self.transformer.transform(old_msg, hosted_contents)
+
+    async def _send(self, url: str, request_body: dict | bytes, channel_id: str) -> str | None:
+        # Posted as JSON, building the SDK's models for it would cost more than the request
+        response = await self.rate_limiter.run(
+            lambda: self._post(url, request_body), channel_id=channel_id
+        )
+        if response.status_code == 409:
+            return None
+        if response.status_code != 201:
+            raise odata_error(response.status_code, error_body(response))
+        return response.json()["id"]
+
+    # https://learn.microsoft.com/en-us/graph/api/chatmessagehostedcontent-get?view=graph-rest-1.0&tabs=http#example-2-get-hosted-content-bytes-for-an-image
+    async def download(
+        self,
+        url: str,
+        write: Callable[[bytes], None],
+        restart: Callable[[], None],
+        channel_id: str | None = None,
+    ) -> str:
+        # Streams the content to write() chunk by chunk and returns its content type. A download
+        # broken off is retried from the start, after restart() discarded what was written.
+        written = False
+
+        async def stream() -> httpx.Response:
+            nonlocal written
+            headers = {"Authorization": "Bearer " + await self.get_access_token()}
+            async with self.http_client.stream("GET", url, headers=headers) as response:
+                if response.status_code == 200:
+                    if written:
+                        restart()
+                    async for chunk in response.aiter_bytes():
+                        written = True
+                        write(chunk)
+                return response
+
+        response = await self.rate_limiter.run(stream, channel_id=channel_id, idempotent=True)
+        response.raise_for_status()
+        return response.headers.get("Content-Type", "application/octet-stream")
 
     # https://learn.microsoft.com/en-us/graph/api/channel-completemigration?view=graph-rest-1.0&tabs=python
     async def complete_channel_migration(self, team_id: str, channel_id: str):
-        await self.client.teams.by_team_id(team_id).channels.by_channel_id(
-            channel_id
-        ).complete_migration.post()
+        await self.rate_limiter.run(
+            lambda: self.client.teams.by_team_id(team_id)
+            .channels.by_channel_id(channel_id)
+            .complete_migration.post(),
+            channel_id=channel_id,
+        )
 
     # https://learn.microsoft.com/en-us/graph/api/team-completemigration?view=graph-rest-1.0&tabs=python
     async def complete_teams_migration(self, team_id: str):
-        await self.client.teams.by_team_id(team_id).complete_migration.post()
-
-    def map_attachments(
-        self, attachments: list[ChatMessageAttachment]
-    ) -> list[ChatMessageAttachment]:
-        print("working on attachments")
-        new_attachments = []
-        for attachment in attachments:
-            if attachment.content_type != "reference":
-                new_attachments.append(attachment)
-                continue
-            was_replaced = False
-            for key, value in self.sharepoint_map.items():
-                if attachment.content_url.startswith(key):
-                    end = attachment.content_url[len(key) :]
-                    id = attachment.id
-                    name = attachment.name
-                    new_attachments.append(
-                        ChatMessageAttachment(
-                            content_type="reference",
-                            content_url=value + end,
-                            id=id,
-                            name=name,
-                        )
-                    )
-                    was_replaced = True
+        await self.rate_limiter.run(
+            lambda: self.client.teams.by_team_id(team_id).complete_migration.post(),
+            team_id=team_id,
+        )
+
+    async def _iter_pages(self, url: str, channel_id: str, prefetch: int) -> AsyncIterator[dict]:
+        # Follows @odata.nextLink in a background task, at most `prefetch` pages ahead of the
+        # consumer. The pages stay JSON, see records.py.
+        pages: asyncio.Queue = asyncio.Queue(maxsize=prefetch)
+
+        async def fetch_pages():
+            try:
+                next_link = url
+                while next_link:
+                    page = await self._get_json(next_link, channel_id)
+                    await pages.put(page)
+                    QUEUED_PAGES.set(channel_id, value=pages.qsize())
+                    next_link = page.get("@odata.nextLink")
+                await pages.put(None)
+            except Exception as error:
+                await pages.put(error)
+
+        fetcher = asyncio.create_task(fetch_pages())
+        try:
+            while True:
+                page = await pages.get()
+                QUEUED_PAGES.set(channel_id, value=pages.qsize())
+                if page is None:
                     break
-            if not was_replaced:
-                print("Didn't replace attachment: %s", attachment.content_url)
-        return new_attachments
-
-    def map_user(self, sender: ChatMessageFromIdentitySet):
-        if sender.user.id in self.user_map.keys():
-            sender.user.id = self.user_map[sender.user.id][1]
-        sender.user.additional_data["tenantId"] = self.tenant_id
-
-    def map_mentions_user(self, mentions: list[ChatMessageMention]):
-        for i in range(len(mentions)):
-            if mentions[i].mentioned.user is not None:
-                self.map_user(mentions[i].mentioned)
-
-    def add_reaction_to_body(self, body: ItemBody, reactions: list[ChatMessageReaction]):
-        if not reactions:
-            return
-        if body.content_type.value != "html":
-            body.content_type = BodyType["Html"]
-            body.content = f"<div>{body.content}</div>"
-        body.content = f"{body.content}\n-----\n"
-        for reaction in reactions:
-            display_name = ""
-            if reaction.user.user.id in self.user_map:
-                display_name = self.user_map[reaction.user.user.id][0]
-            elif reaction.user.user.display_name is not None:
-                display_name = reaction.user.user.display_name
-            else:
-                display_name = reaction.user.user.id
-            body.content = (
-                f"{body.content}<p>{display_name}'s Reaktion: {reaction.reaction_type}</p>\n"
-            )
-        body.content = f"{body.content}-----"
-
-    def replace_inexistant_users(self, request: ChatMessage):
-        if request.from_.user.id in self.user_map.keys():
-            return
-        if request.body.content_type.value != "html":
-            request.body.content_type = BodyType["Html"]
-            request.body.content = f"<div>{request.body.content}</div>"
-        request.body.content = f"\n<p>-----</p>\n<b>Original message from: {request.from_.user.display_name}</b>\n<p>-----</p>\n{request.body.content}"
-        request.from_.user.id = self.default_user[0]
-        request.from_.user.display_name = self.default_user[1]
+                if isinstance(page, Exception):
+                    raise page
+                yield page
+        finally:
+            fetcher.cancel()
+
+    async def close(self):
+        await self.http_client.aclose()
+
+    async def get_access_token(self) -> str:
+        async with self.access_token_lock:
+            if (
+                self.access_token is None
+                or self.access_token.expires_on - TOKEN_REFRESH_MARGIN < time.time()
+            ):
+                self.access_token = await self.credential.get_token(self.graph_scopes[0])
+            return self.access_token.token
+
+    async def _post(self, url: str, json_body: dict | bytes) -> httpx.Response:
+        # Bytes are JSON encoded already
+        headers = {
+            "Authorization": "Bearer " + await self.get_access_token(),
+            "Content-Type": "application/json",
+        }
+        if isinstance(json_body, bytes):
+            return await self.http_client.post(url, headers=headers, content=json_body)
+        return await self.http_client.post(url, headers=headers, json=json_body)
+
+    async def _get_json(self, url: str, channel_id: str | None = None) -> dict:
+        async def get() -> httpx.Response:
+            headers = {"Authorization": "Bearer " + await self.get_access_token()}
+            return await self.http_client.get(url, headers=headers)
+
+        response = await self.rate_limiter.run(get, channel_id=channel_id, idempotent=True)
+        if response.status_code != 200:
+            raise odata_error(response.status_code, error_body(response))
+        return response.json()
+
+
+def is_posted_message(message: dict) -> bool:
+    # System events (members added, channel renamed, ...) and deleted messages aren't migrated
+    return message.get("messageType") == "message" and message.get("deletedDateTime") is None
+
+
+def error_body(response: httpx.Response) -> dict | None:
+    # Gateways answer some errors (e.g. 502, 504) with HTML or an empty body
+    try:
+        return response.json()
+    except ValueError:
+        return None
+
+
+def odata_error(status_code: int, body: dict | None) -> ODataError:
+    # The error of a raw request, as the SDK would have raised it
+    from msgraph.generated.models.o_data_errors.o_data_error import ODataError
+
+    error = JsonParseNode(body or {}).get_object_value(ODataError)
+    error.response_status_code = status_code
+    return error
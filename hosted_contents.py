@@ -0,0 +1,141 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from collections.abc import AsyncIterator
+
+from graph import Graph
+from records import MessageRecord
+from transform import HostedContent, hosted_content_urls
+
+logger = logging.getLogger(__name__)
+
+# Hosted contents downloaded at the same time
+DOWNLOAD_CONCURRENCY = 8
+
+URLS_FILE = "urls.jsonl"
+
+
+class HostedContentStore:
+    # Content addressed store of the downloaded hosted contents: every content is kept once in
+    # <path>/<sha256>, however often it was pasted. urls.jsonl maps the URLs of the old tenant
+    # to their content, so a URL is only downloaded once, also across runs. The bytes are
+    # streamed to disk and only read into memory to send the message that uses them.
+    path: str
+    source: Graph | None
+    contents: dict[str, HostedContent]
+    downloads: dict[str, asyncio.Future]
+    download_slots: asyncio.Semaphore
+
+    def __init__(
+        self, path: str, source: Graph | None, download_concurrency: int = DOWNLOAD_CONCURRENCY
+    ):
+        # Without a source (importing an archive) only contents stored before are available
+        self.path = path
+        self.source = source
+        self.contents = {}
+        self.downloads = {}
+        self.download_slots = asyncio.Semaphore(download_concurrency)
+        os.makedirs(path, exist_ok=True)
+        urls_path = os.path.join(path, URLS_FILE)
+        if os.path.exists(urls_path):
+            with open(urls_path, encoding="utf-8") as urls_file:
+                for line in urls_file:
+                    entry = json.loads(line)
+                    self.contents[entry["url"]] = HostedContent(
+                        entry["sha256"],
+                        entry["contentType"],
+                        os.path.join(path, entry["sha256"]),
+                    )
+
+    async def fetch_messages(
+        self, messages: list[MessageRecord], channel_id: str
+    ) -> dict[str, HostedContent]:
+        # The hosted contents of a thread, downloaded concurrently. Missing contents are left out,
+        # their images keep pointing at the old tenant.
+        urls = {url for message in messages for url in hosted_content_urls(message)}
+        contents = await asyncio.gather(*(self.fetch(url, channel_id) for url in urls))
+        return {url: content for url, content in zip(urls, contents) if content is not None}
+
+    async def fetch(self, url: str, channel_id: str) -> HostedContent | None:
+        if url in self.contents:
+            return self.contents[url]
+        if self.source is None:
+            logger.warning("Hosted content %s is not part of the archive", url)
+            return None
+        # Concurrent requests for the same URL share one download
+        download = self.downloads.get(url)
+        if download is None:
+            download = self.downloads[url] = asyncio.ensure_future(self._download(url, channel_id))
+            download.add_done_callback(lambda _: self.downloads.pop(url, None))
+        return await asyncio.shield(download)
+
+    async def _download(self, url: str, channel_id: str) -> HostedContent | None:
+        async with self.download_slots:
+            temporary_path = os.path.join(self.path, f"download-{id(asyncio.current_task())}.tmp")
+            sha256 = hashlib.sha256()
+            try:
+                with open(temporary_path, "wb") as content_file:
+
+                    def write(chunk: bytes):
+                        sha256.update(chunk)
+                        content_file.write(chunk)
+
+                    def restart():
+                        nonlocal sha256
+                        sha256 = hashlib.sha256()
+                        content_file.seek(0)
+                        content_file.truncate()
+
+                    content_type = await self.source.download(
+                        url, write, restart, channel_id=channel_id
+                    )
+                digest = sha256.hexdigest()
+                content_path = os.path.join(self.path, digest)
+                # Already stored under another URL, e.g. the same image pasted again
+                if not os.path.exists(content_path):
+                    os.replace(temporary_path, content_path)
+            except Exception as error:
+                logger.warning("Could not download hosted content %s: %s", url, error)
+                return None
+            finally:
+                if os.path.exists(temporary_path):
+                    os.remove(temporary_path)
+        content = self.contents[url] = HostedContent(digest, content_type, content_path)
+        with open(os.path.join(self.path, URLS_FILE), "a", encoding="utf-8") as urls_file:
+            urls_file.write(
+                json.dumps({"url": url, "sha256": digest, "contentType": content_type}) + "\n"
+            )
+        return content
+
+
+async def with_hosted_contents(
+    threads: AsyncIterator[tuple[MessageRecord, list[MessageRecord]]],
+    store: HostedContentStore | None,
+    channel_id: str,
+    window: int = DOWNLOAD_CONCURRENCY,
+) -> AsyncIterator[tuple[MessageRecord, list[MessageRecord]]]:
+    # Passes the threads on in order, once the hosted contents of up to `window` threads ahead
+    # are downloaded
+    if store is None:
+        async for thread in threads:
+            yield thread
+        return
+    pending: list[tuple[tuple[MessageRecord, list[MessageRecord]], asyncio.Task]] = []
+    try:
+        async for thread in threads:
+            message, replies = thread
+            pending.append(
+                (thread, asyncio.create_task(store.fetch_messages([message, *replies], channel_id)))
+            )
+            if len(pending) > window:
+                thread, fetching = pending.pop(0)
+                await fetching
+                yield thread
+        for thread, fetching in pending:
+            await fetching
+            yield thread
+    finally:
+        for _, fetching in pending:
+            fetching.cancel()
@@ -0,0 +1,133 @@
+import sqlite3
+from datetime import datetime
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS teams (
+    old_team_id TEXT PRIMARY KEY,
+    new_team_id TEXT NOT NULL,
+    completed INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS channels (
+    old_channel_id TEXT PRIMARY KEY,
+    old_team_id TEXT NOT NULL,
+    new_channel_id TEXT NOT NULL,
+    completed INTEGER NOT NULL DEFAULT 0,
+    synced_at TEXT,
+    delta_link TEXT
+);
+CREATE TABLE IF NOT EXISTS planned_teams (
+    old_team_id TEXT PRIMARY KEY,
+    writes INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    old_channel_id TEXT NOT NULL,
+    old_message_id TEXT NOT NULL,
+    old_parent_id TEXT,
+    new_message_id TEXT,
+    PRIMARY KEY (old_channel_id, old_message_id)
+);
+"""
+
+
+class MigrationJournal:
+    # Records what has already been written to the new tenant, so an interrupted migration
+    # resumes where it stopped instead of sending messages twice or dropping replies
+    path: str
+    connection: sqlite3.Connection
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        # Every write is its own transaction: WAL keeps them cheap and crash safe
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def is_team_completed(self, old_team_id: str) -> bool:
+        row = self.connection.execute(
+            "SELECT completed FROM teams WHERE old_team_id = ?", (old_team_id,)
+        ).fetchone()
+        return row is not None and bool(row[0])
+
+    def complete_team(self, old_team_id: str, new_team_id: str):
+        self.connection.execute(
+            "INSERT INTO teams (old_team_id, new_team_id, completed) VALUES (?, ?, 1) "
+            "ON CONFLICT (old_team_id) DO UPDATE SET new_team_id = excluded.new_team_id, completed = 1",
+            (old_team_id, new_team_id),
+        )
+
+    def record_planned_writes(self, old_team_id: str, writes: int):
+        # Messages and replies a plan run counted as still to be sent, see planner.py
+        self.connection.execute(
+            "INSERT OR REPLACE INTO planned_teams (old_team_id, writes) VALUES (?, ?)",
+            (old_team_id, writes),
+        )
+
+    def get_planned_writes(self) -> dict[str, int]:
+        return dict(self.connection.execute("SELECT old_team_id, writes FROM planned_teams"))
+
+    def get_channel(self, old_channel_id: str) -> tuple[str | None, bool]:
+        row = self.connection.execute(
+            "SELECT new_channel_id, completed FROM channels WHERE old_channel_id = ?",
+            (old_channel_id,),
+        ).fetchone()
+        return (row[0], bool(row[1])) if row is not None else (None, False)
+
+    def record_channel(self, old_team_id: str, old_channel_id: str, new_channel_id: str):
+        self.connection.execute(
+            "INSERT INTO channels (old_channel_id, old_team_id, new_channel_id) VALUES (?, ?, ?) "
+            "ON CONFLICT (old_channel_id) DO UPDATE SET new_channel_id = excluded.new_channel_id",
+            (old_channel_id, old_team_id, new_channel_id),
+        )
+
+    def complete_channel(self, old_channel_id: str):
+        self.connection.execute(
+            "UPDATE channels SET completed = 1 WHERE old_channel_id = ?", (old_channel_id,)
+        )
+
+    def get_sync_state(self, old_channel_id: str) -> tuple[datetime | None, str | None]:
+        # (start of the last full read, delta link of the last incremental read)
+        row = self.connection.execute(
+            "SELECT synced_at, delta_link FROM channels WHERE old_channel_id = ?",
+            (old_channel_id,),
+        ).fetchone()
+        if row is None:
+            return None, None
+        return (datetime.fromisoformat(row[0]) if row[0] else None), row[1]
+
+    def record_synced_at(self, old_channel_id: str, synced_at: datetime):
+        self.connection.execute(
+            "UPDATE channels SET synced_at = ? WHERE old_channel_id = ?",
+            (synced_at.isoformat(), old_channel_id),
+        )
+
+    def record_delta_link(self, old_channel_id: str, delta_link: str):
+        self.connection.execute(
+            "UPDATE channels SET delta_link = ? WHERE old_channel_id = ?",
+            (delta_link, old_channel_id),
+        )
+
+    def get_message(self, old_channel_id: str, old_message_id: str) -> tuple[bool, str | None]:
+        # (already sent, new id): the new id is unknown for messages the new tenant reported as
+        # existing (409) before they were recorded
+        row = self.connection.execute(
+            "SELECT new_message_id FROM messages WHERE old_channel_id = ? AND old_message_id = ?",
+            (old_channel_id, old_message_id),
+        ).fetchone()
+        return (True, row[0]) if row is not None else (False, None)
+
+    def record_message(
+        self,
+        old_channel_id: str,
+        old_message_id: str,
+        new_message_id: str | None,
+        old_parent_id: str | None = None,
+    ):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO messages (old_channel_id, old_message_id, old_parent_id, new_message_id) "
+            "VALUES (?, ?, ?, ?)",
+            (old_channel_id, old_message_id, old_parent_id, new_message_id),
+        )
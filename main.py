@@ -1,14 +1,46 @@
+from __future__ import annotations
+
+import argparse
 import asyncio
 import configparser
-from msgraph.generated.models.o_data_errors.o_data_error import ODataError
+import logging
+import os
+from typing import TYPE_CHECKING
+from kiota_abstractions.api_error import APIError
+from archive import HOSTED_CONTENTS_DIR, ArchiveReader, ArchiveWriter
 from graph import Graph
+from hosted_contents import HostedContentStore, with_hosted_contents
+from journal import MigrationJournal
+from metrics import CHANNELS, MIGRATED, REGISTRY, Progress
+from pipeline import ChannelPipeline, QueueBudget
+from records import MessageRecord, PreparedMessage
+from transform_pool import TransformPool
+import planner
+import verify
+from users import UserCache
 import time
+from collections.abc import Awaitable, Callable
+from datetime import datetime, timezone
+
+if TYPE_CHECKING:
+    from msgraph.generated.models.channel import Channel
+
+logger = logging.getLogger("main")
 
 
-async def main():
-    print("Teams migrator\n")
-    print("BE AWARE OF THROTTELING: https://learn.microsoft.com/en-us/graph/throttling-limits")
-    print("SDK handles throtteling internally")
+async def main(args: argparse.Namespace):
+    logging.basicConfig(
+        level=args.log_level, format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+    # httpx logs every request at INFO, the metrics cover them
+    logging.getLogger("httpx").setLevel(max(logging.WARNING, logging.getLevelName(args.log_level)))
+    logger.info("Teams migrator")
+    logger.info(
+        "BE AWARE OF THROTTELING: https://learn.microsoft.com/en-us/graph/throttling-limits"
+    )
+    logger.info(
+        "Requests are paced per app, team and channel and retried on 429/503/504 (Retry-After)"
+    )
 
     # Load settings
     config_old = configparser.ConfigParser()
@@ -20,14 +52,25 @@ async def main():
 
     default_user = ["00000000-0000-0000-0000-000000000000", "John Doe"]
 
+    # Rules to match the users of the old tenant to the new tenant, tried in order: the
+    # attribute compared and a mapping of the old tenant's mail domains to the new ones
+    user_match_rules = [
+        ("userPrincipalName", {"old-teams.onmicrosoft.com": "new-teams.onmicrosoft.com"}),
+        ("mail", {}),
+    ]
+    # Users of both tenants, read by the users mode
+    user_cache = UserCache()
+
     # Key: User object ID in old tenant
     # Value: tuple of (Display name in old tenant, object ID in new tenant)
+    # Users matched by user_match_rules are added, the entries here take precedence
     user_map = {
         "00000000-0000-0000-0000-000000000000": (
             "John Doe",
             "00000000-0000-0000-0000-000000000000",
         ),
     }
+    user_map = {**user_cache.user_map(user_match_rules), **user_map}
 
     sharepoint_map = {
         "https://old-teams.sharepoint.com/sites/old-teams-site/Freigegebene Dokumente": "https://new-teams.sharepoint.com/sites/new-teams-site/Shared Documents",
@@ -49,72 +92,707 @@ async def main():
 
     #new_teams_id = await new_teams.create_teams("New Teams display_name", "New Teams description")
     #print(new_teams_id)
-    teams_to_import = {"New Team Name": "00000000-0000-0000-0000-000000000000"}
+    # Mapping of old teams name (as in teams_to_export) to the id of the new team to import into
+    teams_to_import = {"Old Team Name": "00000000-0000-0000-0000-000000000000"}
+
+    # Progress of the migration, an interrupted run resumes from it
+    journal = MigrationJournal("migration-journal.sqlite3")
+
+    # Number of channels migrated concurrently across all teams (the General channel of a team
+    # always runs last)
+    channel_concurrency = 4
+    # Number of teams migrated concurrently, the largest teams are started first
+    team_concurrency = 4
+    # Number of threads posted concurrently within a channel, replies stay in order per thread
+    thread_concurrency = 4
+    # Threads read but not yet posted, across all channels: the reading of the old tenant pauses
+    # when either limit is reached, channels with less of it read first
+    queue_messages = 5000
+    queue_bytes = 64 * 2**20
+    # Worker processes parsing and transforming the archive in the import mode, None for one
+    # per core, 0 to do it in the event loop
+    transform_workers = None
 
+    new_team_ids = {
+        old_team_id: teams_to_import[team_name]
+        for team_name, old_team_id in teams_to_export.items()
+    }
+    # A team's size orders the teams, largest first: its messages and replies as counted by the
+    # export (import mode) or by a previous plan run (recorded in the journal). Without them,
+    # the number of its channels to export, which says little about how long a team takes.
+    team_sizes = {
+        old_team_id: len(channels_to_export.get(old_team_id, ())) for old_team_id in new_team_ids
+    }
+    if args.mode == "import":
+        team_messages = ArchiveReader(args.archive).count_team_messages(channels_to_export)
+        team_sizes = {old_team_id: team_messages.get(old_team_id, 0) for old_team_id in team_sizes}
+    elif args.mode == "migrate":
+        planned_writes = journal.get_planned_writes()
+        if planned_writes.keys() >= team_sizes.keys():
+            team_sizes = {old_team_id: planned_writes[old_team_id] for old_team_id in team_sizes}
+        else:
+            logger.info("Teams are ordered by their number of channels, run the plan mode first")
+    channel_slots = asyncio.Semaphore(channel_concurrency)
+    queue_budget = QueueBudget(queue_messages, queue_bytes)
+    transform_pool = None
+    # Known up front when importing, otherwise the progress line extrapolates the ETA
+    expected_messages = None
+    if args.mode == "import":
+        expected_messages = sum(team_sizes.values())
+    if args.metrics_port:
+        REGISTRY.serve(args.metrics_port)
+    progress_report = asyncio.create_task(
+        report_progress([old_teams, new_teams], Progress(expected_messages), 60, args.metrics_file)
+    )
     try:
-        await export_team(
-            old_teams,
-            new_teams,
-            teams_to_export["Old Team Name"],
-            teams_to_import["New Team Name"],
-            channels_to_export,
+        if args.mode == "users":
+            # Reads both directories (only the changes after the first run), sends nothing
+            for tenant, graph in (("old", old_teams), ("new", new_teams)):
+                changes = await user_cache.refresh(tenant, graph)
+                logger.info("%d users of the %s tenant added, changed or removed", changes, tenant)
+            user_cache.save()
+            user_cache.user_map(user_match_rules)
+        elif args.mode == "verify":
+            # Reads both tenants, compares what the journal records as migrated
+            channel_reports = await asyncio.gather(
+                *(
+                    verify.verify_team(
+                        old_teams,
+                        new_teams,
+                        old_team_id,
+                        new_team_id,
+                        channels_to_export,
+                        journal,
+                        channel_slots,
+                    )
+                    for old_team_id, new_team_id in new_team_ids.items()
+                )
+            )
+            verify.report(
+                [channel_report for reports in channel_reports for channel_report in reports]
+            )
+        elif args.mode == "plan":
+            # Reads the old tenant only, nothing is sent to the new one
+            team_plans = await asyncio.gather(
+                *(
+                    planner.plan_team(
+                        old_teams, old_team_id, channels_to_export, journal, channel_slots
+                    )
+                    for old_team_id in new_team_ids
+                )
+            )
+            # Orders the teams of the following migrate runs
+            for team_plan in team_plans:
+                journal.record_planned_writes(team_plan.team_id, team_plan.writes)
+            planner.report(
+                team_plans,
+                new_teams.rate_limiter.limits,
+                team_concurrency,
+                channel_concurrency,
+                thread_concurrency,
+            )
+        elif args.mode == "export":
+            archive = ArchiveWriter(args.archive)
+            hosted_content_store = HostedContentStore(
+                os.path.join(args.archive, HOSTED_CONTENTS_DIR), old_teams
+            )
+            await schedule_teams(
+                team_sizes,
+                team_concurrency,
+                lambda old_team_id: archive_team(
+                    old_teams,
+                    old_team_id,
+                    channels_to_export,
+                    archive,
+                    channel_slots,
+                    args.incremental,
+                    hosted_content_store,
+                ),
+            )
+        else:
+            # The import mode replays an archive instead of reading the old tenant
+            if args.mode == "import":
+                source = ArchiveReader(args.archive)
+                hosted_content_store = HostedContentStore(
+                    os.path.join(args.archive, HOSTED_CONTENTS_DIR), None
+                )
+                if transform_workers != 0:
+                    transform_pool = TransformPool(
+                        new_teams.transformer, hosted_content_store.contents, transform_workers
+                    )
+            else:
+                source = old_teams
+                hosted_content_store = HostedContentStore("hosted-contents", old_teams)
+            await schedule_teams(
+                team_sizes,
+                team_concurrency,
+                lambda old_team_id: export_team(
+                    source,
+                    new_teams,
+                    old_team_id,
+                    new_team_ids[old_team_id],
+                    channels_to_export,
+                    journal,
+                    channel_slots,
+                    args.incremental,
+                    args.defer_completion,
+                    thread_concurrency,
+                    hosted_content_store,
+                    queue_budget,
+                    transform_pool,
+                ),
+            )
+    except APIError as api_error:
+        logger.error("Error: %s", describe_error(api_error))
+    finally:
+        progress_report.cancel()
+        if transform_pool is not None:
+            transform_pool.close()
+        if args.metrics_file:
+            REGISTRY.write(args.metrics_file)
+        await old_teams.close()
+        await new_teams.close()
+        journal.close()
+
+
+async def report_progress(
+    graphs: list[Graph], progress: Progress, interval: float, metrics_file: str | None
+):
+    while True:
+        await asyncio.sleep(interval)
+        logger.info("Progress: %s", progress.describe())
+        for graph in graphs:
+            logger.info("Throttling state %s: %s", graph.tenant_id, graph.rate_limiter.describe())
+        if metrics_file:
+            REGISTRY.write(metrics_file)
+
+
+async def schedule_teams(
+    team_sizes: dict[str, int],
+    team_concurrency: int,
+    migrate_team: Callable[[str], Awaitable[None]],
+):
+    # Largest teams first, so the slowest team doesn't become the tail. Waiters on a semaphore
+    # are served in order, so the teams also start in this order.
+    team_slots = asyncio.Semaphore(team_concurrency)
+    failed_teams = []
+
+    async def run_team(old_team_id: str):
+        async with team_slots:
+            try:
+                await migrate_team(old_team_id)
+            except APIError as api_error:
+                failed_teams.append(old_team_id)
+                logger.error("Error migrating team %s: %s", old_team_id, describe_error(api_error))
+            except Exception:
+                # E.g. a network error that outlasted the retries, the other teams go on
+                failed_teams.append(old_team_id)
+                logger.exception("Error migrating team %s", old_team_id)
+
+    await asyncio.gather(
+        *(
+            run_team(old_team_id)
+            for old_team_id in sorted(team_sizes, key=team_sizes.get, reverse=True)
         )
-    except ODataError as odata_error:
-        print("Error:")
-        if odata_error.error:
-            print(odata_error.error.code, odata_error.error.message)
+    )
+    logger.info("%d of %d teams done", len(team_sizes) - len(failed_teams), len(team_sizes))
+    if failed_teams:
+        logger.error("failed teams, re-run to resume them: %s", ", ".join(failed_teams))
+
+
+async def gather_channels(channel_migrations: list[Awaitable[None]]):
+    # Like asyncio.gather, but the first failing channel cancels the others of its team, which
+    # would otherwise keep running with their channel slots and queue budget
+    tasks = [asyncio.ensure_future(channel_migration) for channel_migration in channel_migrations]
+    if not tasks:
+        return
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    for task in done:
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
 
 
 async def export_team(
-    old_teams: Graph,
+    old_teams: Graph | ArchiveReader,
     new_teams: Graph,
     old_team_id: str,
     new_team_id: str,
     channel_names: dict[str, set[str]],
+    journal: MigrationJournal,
+    channel_slots: asyncio.Semaphore,
+    incremental: bool = False,
+    defer_completion: bool = False,
+    thread_concurrency: int = 1,
+    hosted_content_store: HostedContentStore | None = None,
+    queue_budget: QueueBudget | None = None,
+    transform_pool: TransformPool | None = None,
 ):
+    if journal.is_team_completed(old_team_id):
+        logger.info("skipping team %s, its migration was already completed", old_team_id)
+        return
     channels = await old_teams.list_all_channels(old_team_id)
+    general_channel = await old_teams.get_primary_channel(old_team_id)
+    selected_channels = []
     for channel in channels:
         if channel.display_name not in channel_names[old_team_id]:
-            print(f"skipping channel: {channel.display_name} {channel.id}")
+            logger.info("skipping channel: %s %s", channel.display_name, channel.id)
             continue
-        print(f"work on channel: {channel.display_name} {channel.id}")
-        new_channel = await new_teams.get_channel(new_team_id, channel.display_name)
+        selected_channels.append(channel)
+    CHANNELS.inc("pending", amount=len(selected_channels))
+    new_channels = await provision_channels(
+        new_teams, old_team_id, new_team_id, selected_channels, journal
+    )
+
+    # The General channel MUST be migrated last, as completing it completes the whole team
+    await gather_channels(
+        [
+            migrate_channel(
+                old_teams,
+                new_teams,
+                old_team_id,
+                new_team_id,
+                channel,
+                new_channels.get(channel.id),
+                journal,
+                channel_slots,
+                incremental,
+                defer_completion,
+                thread_concurrency,
+                hosted_content_store,
+                queue_budget,
+                transform_pool,
+            )
+            for channel in selected_channels
+            if channel.id != general_channel.id
+        ]
+    )
+    for channel in selected_channels:
+        if channel.id == general_channel.id:
+            await migrate_channel(
+                old_teams,
+                new_teams,
+                old_team_id,
+                new_team_id,
+                channel,
+                new_channels.get(channel.id),
+                journal,
+                channel_slots,
+                incremental,
+                defer_completion,
+                thread_concurrency,
+                hosted_content_store,
+                queue_budget,
+                transform_pool,
+            )
+    logger.info("all channels of team %s migrated", old_team_id)
+    if defer_completion:
+        logger.info("team %s stays in migration mode for further incremental runs", new_team_id)
+        return
+    await complete_teams_migration_when_ready(new_teams, new_team_id)
+    journal.complete_team(old_team_id, new_team_id)
+    logger.info("migration of team %s finished", old_team_id)
+    await new_teams.add_teams_member(new_team_id, new_teams.default_user[0])
+    logger.info("%s added as Teams owner", new_teams.default_user[1])
+
+
+async def provision_channels(
+    new_teams: Graph,
+    old_team_id: str,
+    new_team_id: str,
+    channels: list[Channel],
+    journal: MigrationJournal,
+) -> dict[str, Channel]:
+    # Before any message is sent: the channels of the new team are listed once and the missing
+    # ones created concurrently. Returns the new channel per old channel id, completed channels
+    # are left out.
+    pending_channels = [channel for channel in channels if not journal.get_channel(channel.id)[1]]
+    if not pending_channels:
+        return {}
+    # Channel names are unique regardless of case within a team
+    directory = {
+        new_channel.display_name.casefold(): new_channel
+        for new_channel in await new_teams.list_all_channels(new_team_id)
+    }
+    missing_channels = [
+        channel for channel in pending_channels if channel.display_name.casefold() not in directory
+    ]
+    created_channels = await asyncio.gather(
+        *(new_teams.create_channel(new_team_id, channel) for channel in missing_channels)
+    )
+    for channel, new_channel in zip(missing_channels, created_channels):
+        if new_channel is not None:
+            directory[channel.display_name.casefold()] = new_channel
+    new_channels = {}
+    failed_channels = []
+    for channel in pending_channels:
+        new_channel = directory.get(channel.display_name.casefold())
         if new_channel is None:
-            new_channel = await new_teams.create_channel(new_team_id, channel)
-        print(f"new channel: {new_channel.display_name} {new_channel.id}")
-        channel_members = await old_teams.list_channel_members(old_team_id, channel.id)
-        print("Channel members:")
-        for channel_member in channel_members:
-            print(channel_member.display_name)
-        messages = await old_teams.list_messages(old_team_id, channel.id)
-        print(f"Obtained {len(messages)} old messages")
-        for message in messages:
-            if message.deleted_date_time is not None:
-                continue
-            new_msg = await new_teams.send_message(new_team_id, new_channel.id, message)
-            if new_msg.id == "Msg already exists":
-                print(new_msg.id)
-                continue
-            print(f"Msg {new_msg.id} sent to channel {new_channel.id} in teams {new_team_id}")
-            replies = await old_teams.list_replies(old_team_id, channel.id, message.id)
-            print(f"Obtained {len(replies)} old replies")
-            for reply in replies:
-                if reply.deleted_date_time is not None:
-                    continue
-                new_reply = await new_teams.send_reply(
-                    new_team_id, new_channel.id, new_msg.id, reply
-                )
-                print(
-                    f"Replied {new_reply.id} to msg {new_msg.id} on channel {new_channel.id} in teams {new_team_id}"
+            failed_channels.append(channel.display_name)
+            continue
+        logger.info("new channel: %s %s", new_channel.display_name, new_channel.id)
+        journal.record_channel(old_team_id, channel.id, new_channel.id)
+        new_channels[channel.id] = new_channel
+    if failed_channels:
+        # The team must not be completed without them, that can't be undone. The channels
+        # created so far are recorded and reused by the next run.
+        raise APIError(f"channels {', '.join(failed_channels)} could not be created")
+    return new_channels
+
+
+async def complete_teams_migration_when_ready(
+    new_teams: Graph, new_team_id: str, timeout: float = 300
+):
+    # Completed channels take a moment until the team accepts completing its migration
+    deadline = time.monotonic() + timeout
+    delay = 1
+    while True:
+        try:
+            await new_teams.complete_teams_migration(new_team_id)
+            return
+        except APIError as api_error:
+            if api_error.response_status_code not in (400, 409) or (
+                time.monotonic() + delay > deadline
+            ):
+                raise api_error
+            logger.info(
+                "team %s not ready to complete its migration, retrying in %ds", new_team_id, delay
+            )
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+
+async def migrate_channel(
+    old_teams: Graph | ArchiveReader,
+    new_teams: Graph,
+    old_team_id: str,
+    new_team_id: str,
+    channel: Channel,
+    new_channel: Channel | None,
+    journal: MigrationJournal,
+    channel_slots: asyncio.Semaphore,
+    incremental: bool = False,
+    defer_completion: bool = False,
+    thread_concurrency: int = 1,
+    hosted_content_store: HostedContentStore | None = None,
+    queue_budget: QueueBudget | None = None,
+    transform_pool: TransformPool | None = None,
+):
+    async with channel_slots:
+        CHANNELS.dec("pending")
+        completed = journal.get_channel(channel.id)[1]
+        if completed:
+            logger.info(
+                "skipping channel: %s %s, already migrated", channel.display_name, channel.id
+            )
+            CHANNELS.inc("done")
+            return
+        if new_channel is None:
+            raise APIError(f"channel {channel.display_name} {channel.id} was not provisioned")
+        CHANNELS.inc("running")
+        try:
+            await migrate_channel_messages(
+                old_teams,
+                new_teams,
+                old_team_id,
+                new_team_id,
+                channel,
+                new_channel,
+                journal,
+                incremental,
+                defer_completion,
+                thread_concurrency,
+                hosted_content_store,
+                queue_budget or QueueBudget(),
+                transform_pool,
+            )
+        finally:
+            CHANNELS.dec("running")
+        CHANNELS.inc("done")
+
+
+async def migrate_channel_messages(
+    old_teams: Graph | ArchiveReader,
+    new_teams: Graph,
+    old_team_id: str,
+    new_team_id: str,
+    channel: Channel,
+    new_channel: Channel,
+    journal: MigrationJournal,
+    incremental: bool,
+    defer_completion: bool,
+    thread_concurrency: int,
+    hosted_content_store: HostedContentStore | None,
+    queue_budget: QueueBudget,
+    transform_pool: TransformPool | None = None,
+):
+    logger.info("work on channel: %s %s", channel.display_name, channel.id)
+    channel_members = await old_teams.list_channel_members(old_team_id, channel.id)
+    logger.info(
+        "Channel members: %s",
+        ", ".join(channel_member.display_name or "" for channel_member in channel_members),
+    )
+    # Messages are sent as soon as the first page arrives, further pages are prefetched.
+    # Replies come expanded with their message, long threads are read in JSON batches.
+    # Incremental runs only read what changed since the previous run of the channel.
+    sync_started = datetime.now(timezone.utc)
+    # The delta link is only recorded once every thread read before it has been sent
+    delta_links = []
+    if incremental:
+        synced_at, delta_link = journal.get_sync_state(channel.id)
+        threads = old_teams.iter_delta_threads(
+            old_team_id, channel.id, delta_link, synced_at, delta_links.append
+        )
+    elif transform_pool is not None:
+        # Parsed and transformed by worker processes, inline images included
+        threads = transform_pool.iter_threads(old_teams, old_team_id, channel.id)
+    else:
+        threads = old_teams.iter_threads(old_team_id, channel.id)
+    # Threads are independent, as every message keeps its createdDateTime: the reader runs
+    # ahead within the queue budget while up to thread_concurrency threads are posted at the
+    # same time, all paced by the channel's bucket
+    message_count = 0
+    pipeline = ChannelPipeline(
+        queue_budget,
+        thread_concurrency,
+        lambda message, replies: migrate_thread(
+            new_teams,
+            new_team_id,
+            channel.id,
+            new_channel.id,
+            message,
+            replies,
+            journal,
+            hosted_content_store,
+        ),
+    )
+    try:
+        async for message, replies in threads:
+            message_count += 1
+            await pipeline.put(message, replies)
+        await pipeline.join()
+    finally:
+        pipeline.close()
+        new_teams.forget_messages(new_channel.id)
+    if delta_links:
+        journal.record_delta_link(channel.id, delta_links[-1])
+    if not incremental:
+        journal.record_synced_at(channel.id, sync_started)
+    logger.info("Migrated %d old messages of channel %s", message_count, channel.display_name)
+    if defer_completion:
+        return
+    await new_teams.complete_channel_migration(new_team_id, new_channel.id)
+    journal.complete_channel(channel.id)
+
+
+async def migrate_thread(
+    new_teams: Graph,
+    new_team_id: str,
+    old_channel_id: str,
+    new_channel_id: str,
+    message: MessageRecord | PreparedMessage,
+    replies: list[MessageRecord | PreparedMessage],
+    journal: MigrationJournal,
+    hosted_content_store: HostedContentStore | None = None,
+):
+    # Inline images of the whole thread are downloaded concurrently before it is posted
+    hosted_contents = (
+        await hosted_content_store.fetch_messages([message, *replies], old_channel_id)
+        if hosted_content_store is not None and not isinstance(message, PreparedMessage)
+        else {}
+    )
+    sent, new_msg_id = journal.get_message(old_channel_id, message.id)
+    if not sent:
+        new_msg_id = await new_teams.send_message(
+            new_team_id, new_channel_id, message, hosted_contents
+        )
+        if new_msg_id is None:
+            # Sent by an interrupted run before it could be recorded
+            logger.info("Msg already exists, looking it up in channel %s", new_channel_id)
+            new_msg_id = await new_teams.find_message(
+                new_team_id, new_channel_id, message.created_date_time
+            )
+            if new_msg_id is None:
+                # Left unrecorded, so a later run looks it up again
+                raise APIError(
+                    f"msg {message.id} exists in channel {new_channel_id} but was not found"
                 )
-        await new_teams.complete_channel_migration(new_team_id, new_channel.id)
-    print("all channels migrated")
-    time.sleep(10)
-    await new_teams.complete_teams_migration(new_team_id)
-    print("migration finished")
-    await new_teams.add_teams_member(new_team_id, new_teams.default_user[0])
-    print(f"{new_teams.default_user[1]} added as Teams owner")
+        journal.record_message(old_channel_id, message.id, new_msg_id)
+        MIGRATED.inc(old_channel_id, "message")
+        logger.debug(
+            "Msg %s sent to channel %s in teams %s", new_msg_id, new_channel_id, new_team_id
+        )
+    if new_msg_id is None:
+        logger.warning(
+            "Msg %s has no known new id, skipping its %d replies", message.id, len(replies)
+        )
+        return
+    for reply in replies:
+        if journal.get_message(old_channel_id, reply.id)[0]:
+            continue
+        # None if it already exists
+        new_reply_id = await new_teams.send_reply(
+            new_team_id, new_channel_id, new_msg_id, reply, hosted_contents
+        )
+        journal.record_message(old_channel_id, reply.id, new_reply_id, message.id)
+        MIGRATED.inc(old_channel_id, "reply")
+        logger.debug(
+            "Replied %s to msg %s on channel %s in teams %s",
+            new_reply_id,
+            new_msg_id,
+            new_channel_id,
+            new_team_id,
+        )
+
+
+async def archive_team(
+    old_teams: Graph,
+    old_team_id: str,
+    channel_names: dict[str, set[str]],
+    archive: ArchiveWriter,
+    channel_slots: asyncio.Semaphore,
+    incremental: bool = False,
+    hosted_content_store: HostedContentStore | None = None,
+):
+    channels = [
+        channel
+        for channel in await old_teams.list_all_channels(old_team_id)
+        if channel.display_name in channel_names[old_team_id]
+    ]
+    archive.write_team(old_team_id, await old_teams.get_primary_channel(old_team_id))
+    CHANNELS.inc("pending", amount=len(channels))
+    await asyncio.gather(
+        *(
+            archive_channel(
+                old_teams,
+                old_team_id,
+                channel,
+                archive,
+                channel_slots,
+                incremental,
+                hosted_content_store,
+            )
+            for channel in channels
+        )
+    )
+    logger.info("team %s exported to %s", old_team_id, archive.path)
+
+
+async def archive_channel(
+    old_teams: Graph,
+    old_team_id: str,
+    channel: Channel,
+    archive: ArchiveWriter,
+    channel_slots: asyncio.Semaphore,
+    incremental: bool = False,
+    hosted_content_store: HostedContentStore | None = None,
+):
+    async with channel_slots:
+        CHANNELS.dec("pending")
+        CHANNELS.inc("running")
+        logger.info("export channel: %s %s", channel.display_name, channel.id)
+        channel_members = await old_teams.list_channel_members(old_team_id, channel.id)
+        entry = archive.get_channel(old_team_id, channel.id)
+        if incremental and entry is not None:
+            # New and edited threads are appended to the exported channel
+            delta_links = []
+            message_count, reply_count = await archive.write_channel(
+                old_team_id,
+                channel,
+                channel_members,
+                with_hosted_contents(
+                    old_teams.iter_delta_threads(
+                        old_team_id,
+                        channel.id,
+                        entry.get("deltaLink"),
+                        datetime.fromisoformat(entry["syncedAt"]) if "syncedAt" in entry else None,
+                        delta_links.append,
+                    ),
+                    hosted_content_store,
+                    channel.id,
+                ),
+                append=True,
+            )
+            if delta_links:
+                archive.record_sync_state(old_team_id, channel.id, delta_link=delta_links[-1])
+        else:
+            sync_started = datetime.now(timezone.utc)
+            message_count, reply_count = await archive.write_channel(
+                old_team_id,
+                channel,
+                channel_members,
+                with_hosted_contents(
+                    old_teams.iter_threads(old_team_id, channel.id),
+                    hosted_content_store,
+                    channel.id,
+                ),
+            )
+            archive.record_sync_state(old_team_id, channel.id, synced_at=sync_started)
+        CHANNELS.dec("running")
+        CHANNELS.inc("done")
+        MIGRATED.inc(channel.id, "exported", amount=message_count + reply_count)
+        logger.info(
+            "Exported %d messages and %d replies of channel %s",
+            message_count,
+            reply_count,
+            channel.display_name,
+        )
+
+
+def describe_error(api_error: APIError) -> str:
+    # Graph's errors (ODataError) carry a code and a message
+    error = getattr(api_error, "error", None)
+    return f"{error.code} {error.message}" if error else str(api_error)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Migrate Microsoft Teams between tenants")
+    parser.add_argument(
+        "mode",
+        nargs="?",
+        choices=["migrate", "export", "import", "plan", "users", "verify"],
+        default="migrate",
+        help="migrate: copy from the old to the new tenant directly (default), "
+        "export: write the old tenant to a local archive, "
+        "import: replay a local archive into the new tenant, "
+        "plan: count what a migration would send and project its duration, "
+        "users: refresh the users of both tenants that the user map is matched from, "
+        "verify: compare the migrated channels with the old ones",
+    )
+    parser.add_argument("--archive", default="teams-archive", help="directory of the local archive")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only read messages that are new or edited since the previous migrate or export run",
+    )
+    parser.add_argument(
+        "--defer-completion",
+        action="store_true",
+        help="keep channels and the team in migration mode, so later incremental runs can add to them",
+    )
+    parser.add_argument(
+        "--log-level",
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        help="DEBUG adds a line per message and the request bodies",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help="write the metrics in Prometheus text format to this file every minute",
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, help="serve the metrics in Prometheus text format on this port"
+    )
+    args = parser.parse_args()
+    if args.mode in ("import", "plan", "users", "verify") and args.incremental:
+        parser.error("--incremental applies to the migrate and export modes")
+    return args
 
 
 # Run main
-asyncio.run(main())
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,359 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from a local round trip up to a long Retry-After
+DURATION_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Metric:
+    # Values per label combination, the metric types only differ in how they are updated and
+    # rendered. The registry's lock is shared, updates come from the event loop and the
+    # exporter thread reads them.
+    name: str
+    help: str
+    label_names: tuple[str, ...]
+    kind: str
+    values: dict[tuple[str, ...], float]
+    lock: threading.Lock
+
+    def __init__(
+        self, name: str, help: str, label_names: tuple[str, ...], kind: str, lock: threading.Lock
+    ):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.kind = kind
+        self.values = {}
+        self.lock = lock
+
+    def _key(self, labels: tuple) -> tuple[str, ...]:
+        if len(labels) != len(self.label_names):
+            raise ValueError(f"{self.name} expects the labels {self.label_names}, got {labels}")
+        return tuple(str(label) for label in labels)
+
+    def get(self, *labels) -> float:
+        return self.values.get(self._key(labels), 0.0)
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+    def render(self) -> list[str]:
+        return [
+            f"{self.name}{format_labels(self.label_names, key)} {value}"
+            for key, value in sorted(self.values.items())
+        ]
+
+
+class Counter(Metric):
+    def inc(self, *labels, amount: float = 1):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+
+class Gauge(Metric):
+    def set(self, *labels, value: float):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, *labels, amount: float = 1):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    buckets: tuple[float, ...]
+    # Per label combination: observations per bucket (the last one is +Inf), count and sum
+    observations: dict[tuple[str, ...], list[int]]
+    sums: dict[tuple[str, ...], float]
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label_names: tuple[str, ...],
+        kind: str,
+        lock: threading.Lock,
+        buckets: tuple[float, ...] = DURATION_BUCKETS,
+    ):
+        super().__init__(name, help, label_names, kind, lock)
+        self.buckets = buckets
+        self.observations = {}
+        self.sums = {}
+
+    def observe(self, *labels, value: float):
+        key = self._key(labels)
+        with self.lock:
+            counts = self.observations.get(key)
+            if counts is None:
+                counts = self.observations[key] = [0] * (len(self.buckets) + 1)
+                self.sums[key] = 0.0
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sums[key] += value
+            self.values[key] = self.values.get(key, 0.0) + 1
+
+    def quantile(self, q: float, *labels) -> float | None:
+        # Upper bound of the bucket holding the quantile, across all labels if none are given
+        with self.lock:
+            if labels:
+                rows = [self.observations.get(self._key(labels), [])]
+            else:
+                rows = list(self.observations.values())
+        counts = [sum(column) for column in zip(*rows)] if rows and rows[0] else []
+        total = sum(counts)
+        if not total:
+            return None
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            seen += count
+            if seen >= q * total:
+                return bound
+        return float("inf")
+
+    def render(self) -> list[str]:
+        lines = []
+        for key, counts in sorted(self.observations.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = format_labels(self.label_names + ("le",), key + (le,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.label_names, key)
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{labels} {self.sums[key]}")
+        return lines
+
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    escaped = (
+        value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class MetricsRegistry:
+    metrics: dict[str, Metric]
+    lock: threading.Lock
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, label_names: tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, help, label_names, "counter", self.lock))
+
+    def gauge(self, name: str, help: str, label_names: tuple[str, ...] = ()) -> Gauge:
+        return self._register(Gauge(name, help, label_names, "gauge", self.lock))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        label_names: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DURATION_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, help, label_names, "histogram", self.lock, buckets))
+
+    def render(self) -> str:
+        # https://prometheus.io/docs/instrumenting/exposition_formats/#text-based-format
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            with self.lock:
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        # Atomic, e.g. for the textfile collector of the Prometheus node exporter
+        with open(path + ".tmp", "w", encoding="utf-8") as metrics_file:
+            metrics_file.write(self.render())
+        os.replace(path + ".tmp", path)
+
+    def serve(self, port: int) -> ThreadingHTTPServer:
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                content = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("", port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info("Serving metrics on http://localhost:%d/metrics", port)
+        return server
+
+
+REGISTRY = MetricsRegistry()
+
+REQUEST_DURATION = REGISTRY.histogram(
+    "teams_migrator_request_duration_seconds",
+    "Graph request latency until the response headers, every attempt counted",
+    ("endpoint",),
+)
+REQUESTS = REGISTRY.counter(
+    "teams_migrator_requests_total", "Graph requests by response status", ("endpoint", "status")
+)
+THROTTLED = REGISTRY.counter(
+    "teams_migrator_throttled_total", "Graph responses with status 429 or 503", ("endpoint",)
+)
+RETRIES = REGISTRY.counter(
+    "teams_migrator_retries_total", "Requests retried by the rate limiter after throttling"
+)
+TRANSFERRED_BYTES = REGISTRY.counter(
+    "teams_migrator_transferred_bytes_total", "Bytes of request and response bodies", ("direction",)
+)
+IN_FLIGHT = REGISTRY.gauge(
+    "teams_migrator_requests_in_flight", "Graph requests awaiting a response"
+)
+QUEUED_PAGES = REGISTRY.gauge(
+    "teams_migrator_queued_pages", "Prefetched pages waiting for the consumer", ("channel",)
+)
+QUEUED_WORK = REGISTRY.gauge(
+    "teams_migrator_queued_work",
+    "Threads read but not yet posted, in messages and estimated bytes",
+    ("unit",),
+)
+MIGRATED = REGISTRY.counter(
+    "teams_migrator_migrated_total",
+    "Messages and replies sent to the new tenant",
+    ("channel", "kind"),
+)
+CHANNELS = REGISTRY.gauge(
+    "teams_migrator_channels", "Channels selected for this run by state", ("state",)
+)
+
+# Words of the Graph URLs used by graph.py, every other path segment is an id
+ENDPOINT_WORDS = {
+    "$batch",
+    "$value",
+    "channels",
+    "completeMigration",
+    "delta",
+    "groups",
+    "hostedContents",
+    "members",
+    "messages",
+    "primaryChannel",
+    "replies",
+    "teams",
+    "users",
+}
+
+
+def endpoint_name(method: str, path: str) -> str:
+    # "POST /v1.0/teams/<id>/channels/<id>/messages" becomes "POST teams/channels/messages"
+    segments = path.strip("/").split("/")
+    if segments and segments[0] in ("v1.0", "beta"):
+        segments = segments[1:]
+    return f"{method} " + "/".join(segment for segment in segments if segment in ENDPOINT_WORDS)
+
+
+class Progress:
+    # Progress line with an ETA, based on the CHANNELS and MIGRATED metrics. The expected number
+    # of messages is known when importing an archive, otherwise it is extrapolated from the
+    # channels done so far.
+    started: float
+    expected_messages: int | None
+
+    def __init__(self, expected_messages: int | None = None):
+        self.started = time.monotonic()
+        self.expected_messages = expected_messages
+
+    def describe(self) -> str:
+        elapsed = time.monotonic() - self.started
+        messages = MIGRATED.total()
+        pending, running, done = (CHANNELS.get(state) for state in ("pending", "running", "done"))
+        rate = messages / elapsed if elapsed > 0 else 0.0
+        line = (
+            f"{messages:.0f} messages and replies migrated ({rate:.1f}/s), "
+            f"channels {done:.0f} done, {running:.0f} running, {pending:.0f} pending"
+        )
+        expected = self.expected_messages
+        if expected is None and done:
+            expected = messages / (done + running / 2) * (done + running + pending)
+        if expected and rate:
+            eta = max(expected - messages, 0) / rate
+            line += f", ETA {eta // 3600:.0f}h{eta % 3600 // 60:02.0f}m"
+        latency = REQUEST_DURATION.quantile(0.99)
+        if latency is not None:
+            line += f", p99 latency <= {latency}s"
+        return line
+
+
+class CountingStream(httpx.AsyncByteStream):
+    stream: httpx.AsyncByteStream
+
+    def __init__(self, stream: httpx.AsyncByteStream):
+        self.stream = stream
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            TRANSFERRED_BYTES.inc("received", amount=len(chunk))
+            yield chunk
+
+    async def aclose(self):
+        await self.stream.aclose()
+
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    # Below the SDK's middleware, so retries of its retry handler are measured one by one
+    transport: httpx.AsyncBaseTransport
+
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        endpoint = endpoint_name(request.method, request.url.path)
+        TRANSFERRED_BYTES.inc("sent", amount=len(request.content))
+        IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except Exception:
+            REQUESTS.inc(endpoint, "error")
+            raise
+        finally:
+            IN_FLIGHT.dec()
+        REQUEST_DURATION.observe(endpoint, value=time.perf_counter() - started)
+        REQUESTS.inc(endpoint, response.status_code)
+        if response.status_code in (429, 503):
+            THROTTLED.inc(endpoint)
+        return httpx.Response(
+            response.status_code,
+            headers=response.headers,
+            stream=CountingStream(response.stream),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self):
+        await self.transport.aclose()
@@ -0,0 +1,420 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+# Local stand-in for the Graph endpoints used by graph.py, to measure the migration without a
+# tenant. The old team is generated on the fly, the new team only counts what is posted to it.
+OLD_TEAM_ID = "old-team"
+NEW_TEAM_ID = "new-team"
+OLD_SHAREPOINT = "https://old-teams.sharepoint.com/sites/old-teams-site/Freigegebene Dokumente"
+START = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+
+@dataclass
+class MockSettings:
+    channels: int = 4
+    messages: int = 200
+    replies: int = 3
+    reactions: int = 2
+    users: int = 20
+    page_size: int = 50
+    expanded_replies: int = 1000
+    latency: float = 0.02
+    throttle_rate: float = 0.0
+    retry_after: int = 1
+    # Every images-th message carries an inline image, one of image_variants distinct payloads
+    images: int = 10
+    image_variants: int = 4
+    image_size: int = 50_000
+
+
+@dataclass
+class MockStats:
+    requests: dict[str, int] = field(default_factory=dict)
+    latencies: dict[str, list[float]] = field(default_factory=dict)
+    throttled: int = 0
+    messages: int = 0
+    replies: int = 0
+    hosted_contents: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def record(self, endpoint: str, latency: float):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.latencies.setdefault(endpoint, []).append(latency)
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {
+                "requests": dict(self.requests),
+                "latency": {
+                    endpoint: percentiles(latencies)
+                    for endpoint, latencies in self.latencies.items()
+                },
+                "throttled": self.throttled,
+                "messages": self.messages,
+                "replies": self.replies,
+                "hosted_contents": self.hosted_contents,
+            }
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    ordered = sorted(values)
+    return {
+        "p50": ordered[int(0.5 * (len(ordered) - 1))],
+        "p99": ordered[int(0.99 * (len(ordered) - 1))],
+    }
+
+
+class MockGraph:
+    settings: MockSettings
+    stats: MockStats
+    new_channels: dict[str, dict]
+    lock: threading.Lock
+    next_id: int
+
+    def __init__(self, settings: MockSettings):
+        self.settings = settings
+        self.stats = MockStats()
+        self.new_channels = {"General": self._channel("19:new-general@thread.tacv2", "General")}
+        self.lock = threading.Lock()
+        self.next_id = 1
+
+    def _channel(self, channel_id: str, name: str) -> dict:
+        return {
+            "id": channel_id,
+            "displayName": name,
+            "description": f"{name} channel",
+            "membershipType": "standard",
+            "createdDateTime": START.isoformat().replace("+00:00", "Z"),
+        }
+
+    def old_channels(self) -> list[dict]:
+        return [self._channel("19:old-general@thread.tacv2", "General")] + [
+            self._channel(f"19:old-{i}@thread.tacv2", f"Channel {i}")
+            for i in range(1, self.settings.channels)
+        ]
+
+    def _user(self, index: int) -> dict:
+        return {
+            "id": f"00000000-0000-0000-0000-{index % self.settings.users:012d}",
+            "displayName": f"User {index % self.settings.users}",
+            "userIdentityType": "aadUser",
+        }
+
+    def _image(self, variant: int) -> bytes:
+        return b"\x89PNG\r\n\x1a\n" + bytes([variant % 256]) * self.settings.image_size
+
+    def _message(
+        self,
+        base_url: str,
+        channel_index: int,
+        index: int,
+        reply_index: int | None = None,
+    ) -> dict:
+        # Deterministic synthetic message: text, an emoji, a mention, reactions, a SharePoint
+        # reference attachment on every other message and an inline image on every images-th
+        number = index * 1000 + (reply_index + 1 if reply_index is not None else 0)
+        created = START + timedelta(minutes=number)
+        created_text = created.isoformat().replace("+00:00", "Z")
+        mentioned = self._user(number + 1)
+        message = {
+            "id": str(int(created.timestamp() * 1000)),
+            "replyToId": None,
+            "messageType": "message",
+            "createdDateTime": created_text,
+            "lastModifiedDateTime": created_text,
+            "deletedDateTime": None,
+            "subject": None,
+            "summary": None,
+            "importance": "normal",
+            "from": {"user": self._user(number)},
+            "body": {
+                "contentType": "html",
+                "content": f"<p>Message {number} in channel {channel_index}&nbsp;for "
+                f'<at id="0">{mentioned["displayName"]}</at> '
+                '<emoji id="smile" alt="🙂" title=""></emoji></p>' + "<p>lorem ipsum</p>" * 5,
+            },
+            "attachments": [],
+            "mentions": [
+                {"id": 0, "mentionText": mentioned["displayName"], "mentioned": {"user": mentioned}}
+            ],
+            "reactions": [
+                {
+                    "reactionType": "like",
+                    "createdDateTime": created_text,
+                    "user": {"user": {**self._user(number + 2 + i), "displayName": None}},
+                }
+                for i in range(self.settings.reactions)
+            ],
+        }
+        if number % 2 == 0:
+            message["attachments"].append(
+                {
+                    "id": f"attachment-{number}",
+                    "contentType": "reference",
+                    "contentUrl": f"{OLD_SHAREPOINT}/Channel {channel_index}/file-{number}.docx",
+                    "name": f"file-{number}.docx",
+                }
+            )
+        if self.settings.images and number % self.settings.images == 0:
+            channel_id = self.old_channels()[channel_index]["id"]
+            path = f"teams/{OLD_TEAM_ID}/channels/{channel_id}/messages/{message['id']}"
+            variant = number // self.settings.images % self.settings.image_variants
+            message["body"]["content"] += (
+                f'<p><img src="{base_url}/{path}/hostedContents/image-{variant}/$value" '
+                'style="vertical-align:bottom"></p>'
+            )
+        return message
+
+    def _page(self, base_url: str, path: str, query: dict, items: list, total: int) -> dict:
+        skip = int(query.get("$skiptoken", ["0"])[0])
+        top = int(query.get("$top", [str(self.settings.page_size)])[0])
+        page = {"value": items}
+        if skip + top < total:
+            next_query = {key: values[0] for key, values in query.items()}
+            next_query["$skiptoken"] = str(skip + top)
+            page["@odata.nextLink"] = f"{base_url}{path}?" + "&".join(
+                f"{key}={value}" for key, value in next_query.items()
+            )
+        return page
+
+    def _messages(self, base_url: str, path: str, query: dict, channel_index: int) -> dict:
+        skip = int(query.get("$skiptoken", ["0"])[0])
+        top = min(int(query.get("$top", [str(self.settings.page_size)])[0]), 50)
+        expand = "replies" in query.get("$expand", [""])[0]
+        messages = []
+        for index in range(skip, min(skip + top, self.settings.messages)):
+            message = self._message(base_url, channel_index, index)
+            if expand:
+                count = min(self.settings.replies, self.settings.expanded_replies)
+                message["replies"] = [
+                    self._message(base_url, channel_index, index, reply) for reply in range(count)
+                ]
+                if self.settings.replies > count:
+                    message["replies@odata.nextLink"] = f"{base_url}{path}/{message['id']}/replies"
+            messages.append(message)
+        return self._page(base_url, path, query, messages, self.settings.messages)
+
+    def _replies(self, base_url: str, path: str, query: dict, channel_index: int, message_id: str):
+        skip = int(query.get("$skiptoken", ["0"])[0])
+        top = int(query.get("$top", [str(self.settings.page_size)])[0])
+        index = (int(message_id) - int(START.timestamp() * 1000)) // 60000 // 1000
+        replies = [
+            self._message(base_url, channel_index, index, reply)
+            for reply in range(skip, min(skip + top, self.settings.replies))
+        ]
+        return self._page(base_url, path, query, replies, self.settings.replies)
+
+    def _new_id(self) -> str:
+        with self.lock:
+            self.next_id += 1
+            return str(self.next_id)
+
+    def handle(self, method: str, url: str, body: dict | None, base_url: str):
+        # Returns (endpoint name, status, headers, json body or binary content)
+        parts = urlsplit(url)
+        path = parts.path.removeprefix("/v1.0")
+        query = parse_qs(parts.query)
+        segments = [unquote(segment) for segment in path.strip("/").split("/")]
+        if method == "POST" and segments == ["$batch"]:
+            responses = []
+            for request in body["requests"]:
+                _, status, headers, response = self.handle(
+                    request["method"], request["url"], request.get("body"), base_url
+                )
+                responses.append(
+                    {"id": request["id"], "status": status, "headers": headers, "body": response}
+                )
+            return "POST $batch", 200, {}, {"responses": responses}
+        if method == "POST" and segments == ["teams"]:
+            return "POST teams", 202, {"Content-Location": f"/teams('{NEW_TEAM_ID}')"}, None
+        if segments[0] != "teams" or len(segments) < 3:
+            return f"{method} unknown", 404, {}, {"error": {"code": "NotFound", "message": path}}
+        team_id = segments[1]
+        rest = segments[2:]
+        if rest == ["primaryChannel"]:
+            channel = (
+                self.old_channels()[0] if team_id == OLD_TEAM_ID else self.new_channels["General"]
+            )
+            return "GET primaryChannel", 200, {}, channel
+        if rest == ["completeMigration"]:
+            return "POST team completeMigration", 204, {}, None
+        if rest == ["members"]:
+            return "POST team members", 201, {}, {"id": self._new_id()}
+        if rest == ["channels"] and method == "POST":
+            channel = self._channel(f"19:new-{self._new_id()}@thread.tacv2", body["displayName"])
+            with self.lock:
+                self.new_channels[body["displayName"]] = channel
+            return "POST channels", 201, {}, channel
+        if rest == ["channels"]:
+            channels = (
+                self.old_channels() if team_id == OLD_TEAM_ID else list(self.new_channels.values())
+            )
+            match = re.search(r"displayName eq '(.*)'", query.get("$filter", [""])[0])
+            if match:
+                channels = [
+                    channel for channel in channels if channel["displayName"] == match.group(1)
+                ]
+            return "GET channels", 200, {}, {"value": channels}
+        channel_id = rest[1]
+        channel_index = next(
+            (i for i, channel in enumerate(self.old_channels()) if channel["id"] == channel_id), 0
+        )
+        rest = rest[2:]
+        if rest == ["members"]:
+            members = [
+                {"id": str(i), "displayName": self._user(i)["displayName"], "roles": []}
+                for i in range(min(self.settings.users, 5))
+            ]
+            return "GET channel members", 200, {}, {"value": members}
+        if rest == ["completeMigration"]:
+            return "POST channel completeMigration", 204, {}, None
+        if "hostedContents" in rest and rest[-1] == "$value":
+            variant = int(rest[-2].removeprefix("image-"))
+            return "GET hostedContents", 200, {"Content-Type": "image/png"}, self._image(variant)
+        if rest == ["messages"] and method == "POST":
+            with self.stats.lock:
+                self.stats.messages += 1
+                self.stats.hosted_contents += len(body.get("hostedContents") or [])
+            return "POST messages", 201, {}, {"id": self._new_id()}
+        if rest == ["messages"]:
+            return "GET messages", 200, {}, self._messages(base_url, path, query, channel_index)
+        if len(rest) == 3 and rest[2] == "replies" and method == "POST":
+            with self.stats.lock:
+                self.stats.replies += 1
+                self.stats.hosted_contents += len(body.get("hostedContents") or [])
+            return "POST replies", 201, {}, {"id": self._new_id()}
+        if len(rest) == 3 and rest[2] == "replies":
+            replies = self._replies(base_url, path, query, channel_index, rest[1])
+            return "GET replies", 200, {}, replies
+        return f"{method} unknown", 404, {}, {"error": {"code": "NotFound", "message": path}}
+
+
+class MockGraphHandler(BaseHTTPRequestHandler):
+    server: "MockGraphServer"
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, Nagle would delay the body by a round trip
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def _handle(self, method: str):
+        started = time.perf_counter()
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        mock = self.server.mock
+        if self.path == "/_stats":
+            self._respond(200, {}, mock.stats.summary())
+            return
+        time.sleep(mock.settings.latency)
+        if random.random() < mock.settings.throttle_rate:
+            with mock.stats.lock:
+                mock.stats.throttled += 1
+            endpoint, status, headers = (
+                "throttled",
+                429,
+                {"Retry-After": str(mock.settings.retry_after)},
+            )
+            response = {"error": {"code": "TooManyRequests", "message": "Throttled"}}
+        else:
+            base_url = f"http://{self.headers['Host']}/v1.0"
+            endpoint, status, headers, response = mock.handle(method, self.path, body, base_url)
+        self._respond(status, headers, response)
+        mock.stats.record(endpoint, time.perf_counter() - started)
+
+    def _respond(self, status: int, headers: dict, response: dict | bytes | None):
+        if isinstance(response, bytes):
+            content = response
+        else:
+            content = json.dumps(response).encode() if response is not None else b""
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if content and "Content-Type" not in headers:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class MockGraphServer(ThreadingHTTPServer):
+    daemon_threads = True
+    mock: MockGraph
+
+    def __init__(self, port: int, settings: MockSettings):
+        super().__init__(("127.0.0.1", port), MockGraphHandler)
+        self.mock = MockGraph(settings)
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    defaults = MockSettings()
+    parser.add_argument("--channels", type=int, default=defaults.channels)
+    parser.add_argument("--messages", type=int, default=defaults.messages, help="per channel")
+    parser.add_argument("--replies", type=int, default=defaults.replies, help="per message")
+    parser.add_argument("--reactions", type=int, default=defaults.reactions, help="per message")
+    parser.add_argument("--users", type=int, default=defaults.users)
+    parser.add_argument("--page-size", type=int, default=defaults.page_size)
+    parser.add_argument(
+        "--expanded-replies",
+        type=int,
+        default=defaults.expanded_replies,
+        help="replies returned by $expand=replies",
+    )
+    parser.add_argument("--latency", type=float, default=defaults.latency, help="seconds")
+    parser.add_argument(
+        "--throttle-rate", type=float, default=defaults.throttle_rate, help="share of 429s"
+    )
+    parser.add_argument("--retry-after", type=int, default=defaults.retry_after, help="seconds")
+    parser.add_argument(
+        "--images",
+        type=int,
+        default=defaults.images,
+        help="every n-th message has an inline image, 0 for none",
+    )
+    parser.add_argument(
+        "--image-variants", type=int, default=defaults.image_variants, help="distinct images"
+    )
+    parser.add_argument("--image-size", type=int, default=defaults.image_size, help="bytes")
+
+
+def settings_from_args(args: argparse.Namespace) -> MockSettings:
+    return MockSettings(
+        channels=args.channels,
+        messages=args.messages,
+        replies=args.replies,
+        reactions=args.reactions,
+        users=args.users,
+        page_size=args.page_size,
+        expanded_replies=args.expanded_replies,
+        latency=args.latency,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        images=args.images,
+        image_variants=args.image_variants,
+        image_size=args.image_size,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the Graph API")
+    parser.add_argument("--port", type=int, default=8765)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = MockGraphServer(args.port, settings_from_args(args))
+    print(f"Mock Graph listening on http://127.0.0.1:{args.port}/v1.0, statistics at /_stats")
+    server.serve_forever()
@@ -0,0 +1,173 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from collections.abc import Awaitable, Callable
+
+from metrics import QUEUED_WORK
+from records import MessageRecord, PreparedMessage
+
+logger = logging.getLogger(__name__)
+
+# Threads read from the old tenant but not yet posted to the new one, across all channels
+QUEUE_MESSAGES = 5000
+QUEUE_BYTES = 64 * 2**20
+
+# Estimated memory of a message apart from its body (sender, mentions, attachments, ...)
+MESSAGE_OVERHEAD = 2048
+
+
+def message_size(record: MessageRecord | PreparedMessage) -> int:
+    if isinstance(record, PreparedMessage):
+        return len(record.request_body)
+    return len(record.body_content) + MESSAGE_OVERHEAD
+
+
+def thread_size(
+    message: MessageRecord | PreparedMessage, replies: list[MessageRecord | PreparedMessage]
+) -> int:
+    return sum(message_size(record) for record in (message, *replies))
+
+
+class QueueBudget:
+    # Bounds the memory held between the read and the write side, shared by every channel.
+    # Readers wait for room in order of priority, so a giant channel that reads faster than it
+    # can be written doesn't take the whole budget from the others.
+    max_messages: int
+    max_bytes: int
+    messages: int
+    bytes: int
+    waiting: list[tuple[tuple, int, int, int, asyncio.Future]]
+    sequence: itertools.count
+
+    def __init__(self, max_messages: int = QUEUE_MESSAGES, max_bytes: int = QUEUE_BYTES):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.messages = 0
+        self.bytes = 0
+        self.waiting = []
+        self.sequence = itertools.count()
+
+    def _fits(self, messages: int, size: int) -> bool:
+        # A thread larger than the whole budget is let through alone instead of never
+        return (not self.messages and not self.bytes) or (
+            self.messages + messages <= self.max_messages and self.bytes + size <= self.max_bytes
+        )
+
+    def _take(self, messages: int, size: int):
+        self.messages += messages
+        self.bytes += size
+        QUEUED_WORK.set("messages", value=self.messages)
+        QUEUED_WORK.set("bytes", value=self.bytes)
+
+    async def acquire(self, messages: int, size: int, priority: tuple):
+        if not self.waiting and self._fits(messages, size):
+            self._take(messages, size)
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (priority, next(self.sequence), messages, size, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Granted just before the reader was cancelled
+            if future.done() and not future.cancelled():
+                self.release(messages, size)
+            raise
+
+    def release(self, messages: int, size: int):
+        self.messages -= messages
+        self.bytes -= size
+        QUEUED_WORK.set("messages", value=self.messages)
+        QUEUED_WORK.set("bytes", value=self.bytes)
+        while self.waiting:
+            _, _, messages, size, future = self.waiting[0]
+            if future.cancelled():
+                heapq.heappop(self.waiting)
+                continue
+            if not self._fits(messages, size):
+                break
+            heapq.heappop(self.waiting)
+            self._take(messages, size)
+            future.set_result(None)
+
+
+class ChannelPipeline:
+    # Producer/consumer pipeline of one channel: the reader puts threads, `writers` tasks post
+    # them. Between both, threads wait in a priority queue, the smallest first, so a long thread
+    # doesn't hold back the short ones read after it. Memory is bounded by the shared budget, a
+    # reader that runs out of it waits (backpressure), as do writers without threads.
+    budget: QueueBudget
+    post: Callable[[MessageRecord, list[MessageRecord]], Awaitable[None]]
+    queue: asyncio.PriorityQueue
+    writers: list[asyncio.Task]
+    sequence: itertools.count
+    # Messages admitted so far: channels that had less of the budget are admitted first
+    admitted: int
+
+    def __init__(
+        self,
+        budget: QueueBudget,
+        writers: int,
+        post: Callable[[MessageRecord, list[MessageRecord]], Awaitable[None]],
+    ):
+        self.budget = budget
+        self.post = post
+        self.queue = asyncio.PriorityQueue()
+        self.sequence = itertools.count()
+        self.admitted = 0
+        self.writers = [asyncio.create_task(self._write()) for _ in range(writers)]
+
+    async def _write(self):
+        while True:
+            _, _, message, replies, size = await self.queue.get()
+            try:
+                await self.post(message, replies)
+            finally:
+                self.budget.release(1 + len(replies), size)
+                self.queue.task_done()
+
+    def _raise_failed_writer(self):
+        for writer in self.writers:
+            if writer.done():
+                # A writer only ends by an error, which stops the channel
+                writer.result()
+
+    async def put(self, message: MessageRecord, replies: list[MessageRecord]):
+        self._raise_failed_writer()
+        messages = 1 + len(replies)
+        size = thread_size(message, replies)
+        # Waits for the writers as well: once they have failed, nothing of this channel frees
+        # the budget anymore
+        acquire = asyncio.create_task(
+            self.budget.acquire(messages, size, (self.admitted, messages))
+        )
+        try:
+            await asyncio.wait([acquire, *self.writers], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if not acquire.done():
+                # Gives the budget back if it was granted in the meantime
+                acquire.cancel()
+                await asyncio.gather(acquire, return_exceptions=True)
+        if not acquire.cancelled():
+            acquire.result()
+            self.admitted += messages
+            # Released by close() if a writer has failed
+            self.queue.put_nowait((messages, next(self.sequence), message, replies, size))
+        self._raise_failed_writer()
+
+    async def join(self):
+        # Until every thread put is posted
+        joined = asyncio.create_task(self.queue.join())
+        try:
+            await asyncio.wait([joined, *self.writers], return_when=asyncio.FIRST_COMPLETED)
+            self._raise_failed_writer()
+        finally:
+            joined.cancel()
+
+    def close(self):
+        # Threads still queued (after an error) give their budget back
+        for writer in self.writers:
+            writer.cancel()
+        while not self.queue.empty():
+            _, _, _, replies, size = self.queue.get_nowait()
+            self.budget.release(1 + len(replies), size)
@@ -0,0 +1,267 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import logging
+import math
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+from archive import ArchiveReader
+from graph import Graph
+from journal import MigrationJournal
+
+if TYPE_CHECKING:
+    from msgraph.generated.models.channel import Channel
+
+logger = logging.getLogger(__name__)
+
+# Messages per page, as requested by Graph.iter_threads
+MESSAGES_PAGE_SIZE = 50
+
+# Requests of the new tenant per channel besides the messages: create, complete the migration
+CHANNEL_REQUESTS = 2
+# Requests of the new tenant per team: list the channels, complete the migration, add the owner
+TEAM_REQUESTS = 3
+
+# Seconds until the new tenant answers a message POST. The latencies of the reads made while
+# planning include the parsing of large pages, the request metrics of a previous run
+# (teams_migrator_request_duration_seconds of POST teams/channels/messages) give a better value.
+WRITE_LATENCY = 0.3
+
+
+@dataclass
+class ChannelPlan:
+    team_id: str
+    channel_id: str
+    display_name: str
+    is_general: bool
+    completed: bool = False
+    messages: int = 0
+    replies: int = 0
+    # Messages and replies not yet recorded in the journal, i.e. send_message/send_reply calls
+    writes: int = 0
+    duration: float = 0.0
+
+    @property
+    def reads(self) -> int:
+        return math.ceil(self.messages / MESSAGES_PAGE_SIZE) if not self.completed else 0
+
+
+@dataclass
+class TeamPlan:
+    team_id: str
+    completed: bool = False
+    channels: list[ChannelPlan] = field(default_factory=list)
+    finished_at: float = 0.0
+
+    @property
+    def writes(self) -> int:
+        return sum(channel.writes for channel in self.channels)
+
+
+async def plan_team(
+    old_teams: Graph | ArchiveReader,
+    old_team_id: str,
+    channel_names: dict[str, set[str]],
+    journal: MigrationJournal,
+    channel_slots: asyncio.Semaphore,
+) -> TeamPlan:
+    # Reads like export_team, but only counts and sends nothing
+    team_plan = TeamPlan(old_team_id, journal.is_team_completed(old_team_id))
+    if team_plan.completed:
+        return team_plan
+    channels = await old_teams.list_all_channels(old_team_id)
+    general_channel = await old_teams.get_primary_channel(old_team_id)
+    team_plan.channels = await asyncio.gather(
+        *(
+            plan_channel(
+                old_teams,
+                old_team_id,
+                channel,
+                channel.id == general_channel.id,
+                journal,
+                channel_slots,
+            )
+            for channel in channels
+            if channel.display_name in channel_names[old_team_id]
+        )
+    )
+    return team_plan
+
+
+async def plan_channel(
+    old_teams: Graph | ArchiveReader,
+    old_team_id: str,
+    channel: Channel,
+    is_general: bool,
+    journal: MigrationJournal,
+    channel_slots: asyncio.Semaphore,
+) -> ChannelPlan:
+    channel_plan = ChannelPlan(old_team_id, channel.id, channel.display_name, is_general)
+    channel_plan.completed = journal.get_channel(channel.id)[1]
+    if channel_plan.completed:
+        return channel_plan
+    async with channel_slots:
+        async for message, replies in old_teams.iter_threads(old_team_id, channel.id):
+            channel_plan.messages += 1
+            channel_plan.replies += len(replies)
+            # Resumed runs skip what the journal has already recorded
+            channel_plan.writes += sum(
+                1
+                for chat_message in (message, *replies)
+                if not journal.get_message(channel.id, chat_message.id)[0]
+            )
+    logger.info(
+        "counted channel %s: %d messages, %d replies",
+        channel.display_name,
+        channel_plan.messages,
+        channel_plan.replies,
+    )
+    return channel_plan
+
+
+def project(
+    team_plans: list[TeamPlan],
+    limits: dict[str, tuple[float, float]],
+    write_latency: float,
+    team_concurrency: int,
+    channel_concurrency: int,
+    thread_concurrency: int,
+) -> float:
+    # A channel sends thread_concurrency messages at a time, paced by the channel limit or bound
+    # by the latency
+    seconds_per_request = max(1 / limits["channel"][0], write_latency / thread_concurrency)
+    for team_plan in team_plans:
+        for channel in team_plan.channels:
+            if not channel.completed:
+                channel.duration = (channel.writes + CHANNEL_REQUESTS) * seconds_per_request
+    makespan = simulate(team_plans, team_concurrency, channel_concurrency)
+    # All channels share the per app limit
+    requests = sum(
+        team_plan.writes
+        + TEAM_REQUESTS
+        + sum(channel.reads + CHANNEL_REQUESTS for channel in team_plan.channels)
+        for team_plan in team_plans
+        if not team_plan.completed
+    )
+    return max(makespan, requests / limits["app"][0])
+
+
+def simulate(team_plans: list[TeamPlan], team_concurrency: int, channel_concurrency: int) -> float:
+    # Replays the scheduling of schedule_teams and export_team: largest teams first (by their
+    # writes, which the plan mode records for the migration), channels served in arrival order
+    # by the global channel slots, the General channel after the others
+    queued_teams = sorted(
+        (team_plan for team_plan in team_plans if not team_plan.completed),
+        key=lambda team_plan: team_plan.writes,
+        reverse=True,
+    )
+    now = 0.0
+    free_team_slots = team_concurrency
+    free_channel_slots = channel_concurrency
+    waiting_channels: list[ChannelPlan] = []
+    running: list[tuple[float, int, ChannelPlan]] = []
+    remaining: dict[str, int] = {}
+    teams = {team_plan.team_id: team_plan for team_plan in queued_teams}
+    sequence = 0
+
+    def queue_general(team_plan: TeamPlan):
+        nonlocal free_team_slots
+        general = [channel for channel in team_plan.channels if channel.is_general]
+        if general:
+            waiting_channels.extend(general)
+            remaining[team_plan.team_id] = len(general)
+        else:
+            team_plan.finished_at = now
+            free_team_slots += 1
+
+    while queued_teams or waiting_channels or running:
+        while queued_teams and free_team_slots:
+            team_plan = queued_teams.pop(0)
+            free_team_slots -= 1
+            others = [channel for channel in team_plan.channels if not channel.is_general]
+            remaining[team_plan.team_id] = len(others)
+            waiting_channels.extend(others)
+            if not others:
+                queue_general(team_plan)
+        while waiting_channels and free_channel_slots:
+            channel = waiting_channels.pop(0)
+            free_channel_slots -= 1
+            sequence += 1
+            heapq.heappush(running, (now + channel.duration, sequence, channel))
+        if not running:
+            continue
+        now, _, channel = heapq.heappop(running)
+        free_channel_slots += 1
+        team_plan = teams[channel.team_id]
+        remaining[channel.team_id] -= 1
+        if remaining[channel.team_id] == 0:
+            if channel.is_general or not any(c.is_general for c in team_plan.channels):
+                team_plan.finished_at = now
+                free_team_slots += 1
+            else:
+                queue_general(team_plan)
+    return now
+
+
+def report(
+    team_plans: list[TeamPlan],
+    limits: dict[str, tuple[float, float]],
+    team_concurrency: int,
+    channel_concurrency: int,
+    thread_concurrency: int = 1,
+    write_latency: float = WRITE_LATENCY,
+    largest: int = 10,
+):
+    duration = project(
+        team_plans,
+        limits,
+        write_latency,
+        team_concurrency,
+        channel_concurrency,
+        thread_concurrency,
+    )
+    for team_plan in team_plans:
+        if team_plan.completed:
+            logger.info("team %s: already migrated", team_plan.team_id)
+            continue
+        logger.info(
+            "team %s: %d channels, %d messages, %d replies, %d writes, done after %s",
+            team_plan.team_id,
+            len(team_plan.channels),
+            sum(channel.messages for channel in team_plan.channels),
+            sum(channel.replies for channel in team_plan.channels),
+            team_plan.writes,
+            format_duration(team_plan.finished_at),
+        )
+    channels = sorted(
+        (channel for team_plan in team_plans for channel in team_plan.channels),
+        key=lambda channel: channel.duration,
+        reverse=True,
+    )
+    logger.info("largest channels (critical path):")
+    for channel in channels[:largest]:
+        logger.info(
+            "  %s / %s%s: %d writes, %s",
+            channel.team_id,
+            channel.display_name,
+            " (runs last)" if channel.is_general else "",
+            channel.writes,
+            format_duration(channel.duration),
+        )
+    logger.info(
+        "projected duration: %s for %d writes (%.0f req/s per channel, %.0f ms latency, "
+        "%d threads per channel, %d channels and %d teams at a time)",
+        format_duration(duration),
+        sum(team_plan.writes for team_plan in team_plans),
+        limits["channel"][0],
+        write_latency * 1000,
+        thread_concurrency,
+        channel_concurrency,
+        team_concurrency,
+    )
+
+
+def format_duration(seconds: float) -> str:
+    return f"{seconds // 3600:.0f}h{seconds % 3600 // 60:02.0f}m{seconds % 60:02.0f}s"
@@ -0,0 +1,115 @@
+from dataclasses import dataclass
+from datetime import datetime
+
+# Slim form of the chatMessage JSON of Graph, holding only what the migration reads. Built
+# straight from the response JSON: parsing a page into the SDK's models costs orders of
+# magnitude more CPU than json.loads and keeps a backing store per nested object.
+# https://learn.microsoft.com/en-us/graph/api/resources/chatmessage?view=graph-rest-1.0
+
+
+@dataclass(slots=True)
+class UserRecord:
+    id: str | None
+    display_name: str | None
+    user_identity_type: str | None = None
+
+    @classmethod
+    def from_json(cls, data: dict | None) -> "UserRecord | None":
+        if not data:
+            return None
+        return cls(data.get("id"), data.get("displayName"), data.get("userIdentityType"))
+
+    def to_json(self) -> dict:
+        return {
+            "id": self.id,
+            "displayName": self.display_name,
+            "userIdentityType": self.user_identity_type,
+        }
+
+
+@dataclass(slots=True)
+class ReactionRecord:
+    reaction_type: str
+    user: UserRecord | None
+
+    @classmethod
+    def from_json(cls, data: dict) -> "ReactionRecord":
+        return cls(
+            data.get("reactionType"), UserRecord.from_json((data.get("user") or {}).get("user"))
+        )
+
+    def to_json(self) -> dict:
+        return {
+            "reactionType": self.reaction_type,
+            "user": {"user": self.user.to_json() if self.user is not None else None},
+        }
+
+
+@dataclass(slots=True)
+class MessageRecord:
+    id: str
+    message_type: str
+    created_date_time: datetime
+    subject: str | None
+    summary: str | None
+    body_content_type: str
+    body_content: str
+    sender: UserRecord | None
+    # Display name of the application (bots, connectors) that posted the message
+    application_name: str | None
+    # Mentions and attachments are passed on to the new tenant as they are (apart from user ids
+    # and SharePoint URLs), so they stay in their JSON form. Messages without any share the
+    # empty tuple.
+    mentions: tuple[dict, ...]
+    attachments: tuple[dict, ...]
+    reactions: tuple[ReactionRecord, ...]
+
+    @classmethod
+    def from_json(cls, data: dict) -> "MessageRecord":
+        sender = data.get("from") or {}
+        body = data.get("body") or {}
+        return cls(
+            id=data["id"],
+            message_type=data.get("messageType") or "message",
+            created_date_time=datetime.fromisoformat(data["createdDateTime"]),
+            subject=data.get("subject"),
+            summary=data.get("summary"),
+            body_content_type=body.get("contentType") or "text",
+            body_content=body.get("content") or "",
+            sender=UserRecord.from_json(sender.get("user")),
+            application_name=(sender.get("application") or {}).get("displayName"),
+            mentions=tuple(data.get("mentions") or ()),
+            attachments=tuple(data.get("attachments") or ()),
+            reactions=tuple(
+                ReactionRecord.from_json(reaction) for reaction in data.get("reactions") or ()
+            ),
+        )
+
+    def to_json(self) -> dict:
+        # chatMessage JSON of the fields kept, readable by from_json (used by the archive)
+        sender = {}
+        if self.sender is not None:
+            sender["user"] = self.sender.to_json()
+        if self.application_name is not None:
+            sender["application"] = {"displayName": self.application_name}
+        return {
+            "id": self.id,
+            "messageType": self.message_type,
+            "createdDateTime": self.created_date_time.isoformat(),
+            "subject": self.subject,
+            "summary": self.summary,
+            "body": {"contentType": self.body_content_type, "content": self.body_content},
+            "from": sender or None,
+            "mentions": list(self.mentions),
+            "attachments": list(self.attachments),
+            "reactions": [reaction.to_json() for reaction in self.reactions],
+        }
+
+
+@dataclass(slots=True)
+class PreparedMessage:
+    # A message already transformed into its encoded JSON request body, by a worker process of
+    # an import (see transform_pool.py). Keeps what posting and the journal need.
+    id: str
+    created_date_time: datetime
+    request_body: bytes
@@ -0,0 +1,74 @@
+import asyncio
+import unittest
+
+from pipeline import ChannelPipeline, QueueBudget
+from records import MessageRecord
+
+
+def record(message_id: str) -> MessageRecord:
+    return MessageRecord.from_json(
+        {"id": message_id, "createdDateTime": "2024-01-01T00:00:00+00:00"}
+    )
+
+
+class ChannelPipelineTest(unittest.IsolatedAsyncioTestCase):
+    async def test_posts_every_thread(self):
+        budget = QueueBudget(max_messages=3)
+        posted = []
+
+        async def post(message, replies):
+            await asyncio.sleep(0)
+            posted.append(message.id)
+
+        pipeline = ChannelPipeline(budget, 2, post)
+        try:
+            for i in range(10):
+                await pipeline.put(record(str(i)), [record(f"{i}-reply")])
+            await pipeline.join()
+        finally:
+            pipeline.close()
+        self.assertCountEqual(posted, [str(i) for i in range(10)])
+        self.assertEqual((budget.messages, budget.bytes), (0, 0))
+
+    async def test_put_raises_when_every_writer_failed(self):
+        # The reader waits for budget that only the (failed) writers would have released
+        budget = QueueBudget(max_messages=50)
+
+        async def post(message, replies):
+            raise RuntimeError("post failed")
+
+        pipeline = ChannelPipeline(budget, 4, post)
+        try:
+            with self.assertRaises(RuntimeError):
+                async with asyncio.timeout(5):
+                    for i in range(50):
+                        await pipeline.put(record(str(i)), [])
+                    await pipeline.put(record("long"), [record(str(i)) for i in range(9)])
+        finally:
+            pipeline.close()
+        self.assertEqual((budget.messages, budget.bytes), (0, 0))
+        self.assertFalse(budget.waiting)
+
+    async def test_budget_granted_on_failure_is_given_back(self):
+        budget = QueueBudget(max_messages=1)
+        failed = asyncio.Event()
+
+        async def post(message, replies):
+            await failed.wait()
+            raise RuntimeError("post failed")
+
+        pipeline = ChannelPipeline(budget, 1, post)
+        try:
+            await pipeline.put(record("0"), [])
+            waiting = asyncio.create_task(pipeline.put(record("1"), []))
+            await asyncio.sleep(0)
+            failed.set()
+            with self.assertRaises(RuntimeError):
+                await waiting
+        finally:
+            pipeline.close()
+        self.assertEqual((budget.messages, budget.bytes), (0, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import time
+import unittest
+from email.utils import formatdate
+from unittest import mock
+
+import httpx
+from kiota_abstractions.api_error import APIError
+
+from throttling import RateLimiter, retry_after
+
+UNLIMITED = {scope: (1e9, 1e9) for scope in ("app", "team", "channel")}
+
+
+def responses(*status_codes: int, headers: dict | None = None):
+    # A request answering the given status codes in turn
+    calls = []
+
+    async def request() -> httpx.Response:
+        calls.append(len(calls))
+        return httpx.Response(status_codes[len(calls) - 1], headers=headers)
+
+    return request, calls
+
+
+class RetryAfterTest(unittest.TestCase):
+    def test_seconds(self):
+        self.assertEqual(retry_after({"Retry-After": "3"}, 0), 3.0)
+
+    def test_http_date(self):
+        delay = retry_after({"retry-after": formatdate(time.time() + 30, usegmt=True)}, 0)
+        self.assertAlmostEqual(delay, 30, delta=2)
+
+    def test_back_off_without_header(self):
+        for attempt in range(8):
+            delay = retry_after(None, attempt)
+            self.assertGreaterEqual(delay, min(2**attempt, 60) / 2)
+            self.assertLessEqual(delay, min(2**attempt, 60))
+
+
+class RateLimiterTest(unittest.IsolatedAsyncioTestCase):
+    async def test_honors_retry_after(self):
+        limiter = RateLimiter(UNLIMITED)
+        request, calls = responses(429, 200, headers={"Retry-After": "0.2"})
+        started = time.monotonic()
+        response = await limiter.run(request, channel_id="channel")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(calls), 2)
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        # The channel's bucket is penalized, not the app's
+        self.assertEqual(limiter.buckets["channel:channel"].throttled, 1)
+        self.assertEqual(limiter.buckets["app"].throttled, 0)
+
+    async def test_retries_api_errors(self):
+        limiter = RateLimiter(UNLIMITED)
+        calls = []
+
+        async def request():
+            calls.append(len(calls))
+            if len(calls) == 1:
+                raise APIError(response_status_code=503, response_headers={"Retry-After": "0"})
+            return "done"
+
+        self.assertEqual(await limiter.run(request, team_id="team"), "done")
+        self.assertEqual(len(calls), 2)
+
+    async def test_raises_other_api_errors(self):
+        async def request():
+            raise APIError(response_status_code=404)
+
+        with self.assertRaises(APIError):
+            await RateLimiter(UNLIMITED).run(request)
+
+    async def test_gives_up_after_max_retries(self):
+        limiter = RateLimiter(UNLIMITED, max_retries=2)
+        request, calls = responses(504, 504, 504, headers={"Retry-After": "0"})
+        response = await limiter.run(request, channel_id="channel")
+        self.assertEqual(response.status_code, 504)
+        self.assertEqual(len(calls), 3)
+
+    @mock.patch("throttling.asyncio.sleep")
+    async def test_retries_transport_errors_of_idempotent_requests(self, sleep):
+        limiter = RateLimiter(UNLIMITED)
+        calls = []
+
+        async def request():
+            calls.append(len(calls))
+            if len(calls) < 3:
+                raise httpx.ReadTimeout("timed out")
+            return "done"
+
+        self.assertEqual(await limiter.run(request, idempotent=True), "done")
+        self.assertEqual(len(calls), 3)
+        # Backed off, but not throttled
+        self.assertEqual(sleep.await_count, 2)
+        self.assertEqual(limiter.buckets["app"].throttled, 0)
+
+    async def test_raises_transport_errors_of_other_requests(self):
+        calls = []
+
+        async def request():
+            calls.append(len(calls))
+            raise httpx.ConnectError("connection refused")
+
+        with self.assertRaises(httpx.ConnectError):
+            await RateLimiter(UNLIMITED).run(request)
+        self.assertEqual(len(calls), 1)
+
+    @mock.patch("throttling.asyncio.sleep")
+    async def test_transport_errors_count_towards_max_retries(self, sleep):
+        async def request():
+            raise httpx.RemoteProtocolError("connection reset")
+
+        with self.assertRaises(httpx.RemoteProtocolError):
+            await RateLimiter(UNLIMITED, max_retries=3).run(request, idempotent=True)
+        self.assertEqual(sleep.await_count, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
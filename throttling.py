@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import random
+import time
+from collections.abc import Awaitable, Callable
+from email.utils import parsedate_to_datetime
+from typing import Any, TypeVar
+
+import httpx
+from kiota_abstractions.api_error import APIError
+
+from metrics import RETRIES
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# https://learn.microsoft.com/en-us/graph/throttling-limits#microsoft-teams-service-limits
+# Scope: (requests per second, burst)
+TEAMS_LIMITS = {
+    # 15000 requests every 10 seconds per app per tenant
+    "app": (1500.0, 15000),
+    # 4 requests per second per app on a given team or channel
+    "team": (4.0, 4),
+    "channel": (4.0, 4),
+}
+
+THROTTLED_STATUS_CODES = (429, 503)
+# Retried by run(): throttling and gateway timeouts, as the SDK's retry handler would
+RETRIED_STATUS_CODES = (*THROTTLED_STATUS_CODES, 504)
+
+
+class TokenBucket:
+    max_rate: float
+    rate: float
+    capacity: float
+    tokens: float
+    updated: float
+    blocked_until: float
+    throttled: int
+
+    def __init__(self, rate: float, capacity: float):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.throttled = 0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, cost: float = 1):
+        # Tokens are reserved up front (the balance may go negative), so waiting tasks are
+        # served in arrival order without a lock.
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= cost
+        delay = max(-self.tokens / self.rate, self.blocked_until - now)
+        while delay > 0:
+            await asyncio.sleep(delay)
+            # A Retry-After received while sleeping pushes the reservation back
+            delay = self.blocked_until - time.monotonic()
+
+    def throttle(self, retry_after: float):
+        now = time.monotonic()
+        self._refill(now)
+        self.throttled += 1
+        self.rate = max(self.max_rate / 16, self.rate / 2)
+        self.tokens = min(self.tokens, 0)
+        self.blocked_until = max(self.blocked_until, now + retry_after)
+
+    def recover(self):
+        if self.rate < self.max_rate:
+            self._refill(time.monotonic())
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def state(self) -> dict[str, float]:
+        now = time.monotonic()
+        self._refill(now)
+        return {
+            "rate": round(self.rate, 2),
+            "max_rate": self.max_rate,
+            "tokens": round(self.tokens, 2),
+            "utilization": round(1 - max(self.tokens, 0) / self.capacity, 2),
+            "blocked_for": round(max(self.blocked_until - now, 0), 2),
+            "throttled": self.throttled,
+        }
+
+
+class RateLimiter:
+    limits: dict[str, tuple[float, float]]
+    max_retries: int
+    buckets: dict[str, TokenBucket]
+
+    def __init__(self, limits: dict[str, tuple[float, float]] = TEAMS_LIMITS, max_retries: int = 8):
+        self.limits = limits
+        self.max_retries = max_retries
+        self.buckets = {}
+
+    def _bucket(self, scope: str, key: str) -> TokenBucket:
+        name = f"{scope}:{key}" if key else scope
+        bucket = self.buckets.get(name)
+        if bucket is None:
+            rate, capacity = self.limits[scope]
+            bucket = self.buckets[name] = TokenBucket(rate, capacity)
+        return bucket
+
+    def _scopes(self, team_id: str | None, channel_id: str | None) -> list[TokenBucket]:
+        # Most specific scope last, it is the one penalized on throttling
+        buckets = [self._bucket("app", "")]
+        if channel_id is not None:
+            buckets.append(self._bucket("channel", channel_id))
+        elif team_id is not None:
+            buckets.append(self._bucket("team", team_id))
+        return buckets
+
+    async def run(
+        self,
+        request: Callable[[], Awaitable[T]],
+        team_id: str | None = None,
+        channel_id: str | None = None,
+        cost: float = 1,
+        idempotent: bool = False,
+    ) -> T:
+        # Idempotent requests (reads) are retried on network errors as well, with the same
+        # back-off. Posts aren't, they could have been carried out before the connection broke.
+        buckets = self._scopes(team_id, channel_id)
+        for attempt in range(self.max_retries + 1):
+            for bucket in buckets:
+                await bucket.acquire(cost)
+            try:
+                result = await request()
+            except httpx.TransportError as transport_error:
+                if not idempotent or attempt == self.max_retries:
+                    raise
+                # Not throttled: the buckets keep their rate
+                delay = retry_after(None, attempt)
+                logger.warning(
+                    "%s, retrying in %.1fs (attempt %d)",
+                    type(transport_error).__name__,
+                    delay,
+                    attempt + 1,
+                )
+                RETRIES.inc()
+                await asyncio.sleep(delay)
+                continue
+            except APIError as api_error:
+                if (
+                    api_error.response_status_code not in RETRIED_STATUS_CODES
+                    or attempt == self.max_retries
+                ):
+                    raise
+                headers = api_error.response_headers
+            else:
+                status_code = getattr(result, "status_code", None)
+                if status_code not in RETRIED_STATUS_CODES or attempt == self.max_retries:
+                    for bucket in buckets:
+                        bucket.recover()
+                    return result
+                headers = result.headers
+            delay = retry_after(headers, attempt)
+            logger.warning("Throttled, retrying in %.1fs (attempt %d)", delay, attempt + 1)
+            RETRIES.inc()
+            buckets[-1].throttle(delay)
+        raise AssertionError("unreachable")
+
+    def throttle(
+        self, retry_after: float, team_id: str | None = None, channel_id: str | None = None
+    ):
+        # For throttling reported outside of run(), e.g. by single responses of a JSON batch
+        self._scopes(team_id, channel_id)[-1].throttle(retry_after)
+
+    def snapshot(self) -> dict[str, dict[str, float]]:
+        return {name: bucket.state() for name, bucket in self.buckets.items()}
+
+    def describe(self) -> str:
+        busiest = sorted(
+            self.snapshot().items(), key=lambda item: item[1]["utilization"], reverse=True
+        )[:5]
+        return ", ".join(
+            f"{name} {state['rate']}/{state['max_rate']} rps "
+            f"{state['utilization']:.0%} used, {state['throttled']} throttled"
+            + (f", blocked {state['blocked_for']}s" if state["blocked_for"] else "")
+            for name, state in busiest
+        )
+
+
+def retry_after(headers: Any, attempt: int) -> float:
+    value = None
+    if headers:
+        for name, header in headers.items():
+            if name.lower() == "retry-after":
+                value = header
+                break
+    if value is not None:
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            try:
+                return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+            except (TypeError, ValueError):
+                pass
+    # No usable Retry-After: exponential back-off with jitter
+    return min(2**attempt, 60) * (0.5 + random.random() / 2)
@@ -0,0 +1,241 @@
+import base64
+import logging
+import re
+from collections.abc import Callable
+from dataclasses import dataclass
+
+from records import MessageRecord, ReactionRecord, UserRecord
+
+logger = logging.getLogger(__name__)
+
+# A rule receives the old message and the JSON request body built from it and may change the
+# latter. Rules and replacements are pickled to the worker processes of an import (see
+# transform_pool.py), so they should be module level functions rather than lambdas.
+Rule = Callable[[MessageRecord, dict], None]
+
+
+def emoji_alt(match: re.Match) -> str:
+    return match.group("emoji_alt")
+
+
+# Rewrites applied to the final body content, all in a single pass: (pattern, replacement).
+# A callable replacement receives the match, its patterns should only use named groups.
+BODY_SUBSTITUTIONS: list[tuple[str, str | Callable[[re.Match], str]]] = [
+    ("&nbsp;", " "),
+    # Reformat emojis: <emoji id="smile" alt="🙂" title=""></emoji> becomes 🙂
+    (r'<emoji id="[^"]*" alt="(?P<emoji_alt>[^"]*)" title=""></emoji>', emoji_alt),
+]
+
+# Inline images reference the hosted contents of the old message:
+# <img src="https://graph.microsoft.com/v1.0/teams/<id>/channels/<id>/messages/<id>/hostedContents/<id>/$value">
+HOSTED_CONTENT_PATTERN = re.compile(r'src="([^"]+/hostedContents/[^"/]+/\$value)"')
+
+
+@dataclass
+class HostedContent:
+    # A downloaded hosted content, see hosted_contents.py
+    sha256: str
+    content_type: str
+    path: str
+
+    def read(self) -> bytes:
+        with open(self.path, "rb") as content_file:
+            return content_file.read()
+
+
+def hosted_content_urls(message: MessageRecord) -> list[str]:
+    return HOSTED_CONTENT_PATTERN.findall(message.body_content)
+
+
+class MessageTransformer:
+    # Turns a message of the old tenant into the JSON request body for the new tenant. Built
+    # once per Graph client and shared by send_message and send_reply.
+    tenant_id: str
+    default_user: list[str]
+    user_map: dict[str, str]
+    sharepoint_prefixes: list[tuple[int, dict[str, str]]]
+    substitutions: list[tuple[str, str | Callable[[re.Match], str]]]
+    body_pattern: re.Pattern | None
+    rules: list[Rule]
+
+    def __init__(
+        self,
+        tenant_id: str,
+        default_user: list[str],
+        user_map: dict[str, str],
+        sharepoint_map: dict[str, str],
+    ):
+        self.tenant_id = tenant_id
+        self.default_user = default_user
+        self.user_map = user_map
+        # Longest-prefix index: per prefix length (longest first) a dict of prefix -> replacement,
+        # so a URL costs one lookup per distinct length instead of a scan of the whole map
+        prefixes: dict[int, dict[str, str]] = {}
+        for old_prefix, new_prefix in sharepoint_map.items():
+            prefixes.setdefault(len(old_prefix), {})[old_prefix] = new_prefix
+        self.sharepoint_prefixes = sorted(prefixes.items(), reverse=True)
+        self.substitutions = []
+        self.body_pattern = None
+        self.rules = []
+        for pattern, replacement in BODY_SUBSTITUTIONS:
+            self.add_substitution(pattern, replacement)
+
+    def add_substitution(self, pattern: str, replacement: str | Callable[[re.Match], str]):
+        self.substitutions.append((pattern, replacement))
+        self.body_pattern = re.compile(
+            "|".join(
+                f"(?P<substitution_{i}>{pattern})"
+                for i, (pattern, _) in enumerate(self.substitutions)
+            )
+        )
+
+    def add_rule(self, rule: Rule):
+        self.rules.append(rule)
+
+    def transform(
+        self, old_msg: MessageRecord, hosted_contents: dict[str, HostedContent] | None = None
+    ) -> dict:
+        # The old message is left untouched, everything that changes is copied.
+        # hosted_contents maps the URLs of inline images to their downloaded content.
+        request_body = {
+            "messageType": old_msg.message_type,
+            "createdDateTime": old_msg.created_date_time.isoformat(),
+            "from": self.map_sender(old_msg.sender),
+            "attachments": self.map_attachments(old_msg.attachments),
+            "mentions": self.map_mentions(old_msg.mentions),
+        }
+        if old_msg.subject is not None:
+            request_body["subject"] = old_msg.subject
+        if old_msg.summary is not None:
+            request_body["summary"] = old_msg.summary
+        sender = old_msg.sender
+        is_known_user = sender is not None and sender.id in self.user_map
+        reactions = old_msg.reactions
+        content_type = old_msg.body_content_type
+        content = old_msg.body_content
+        if (not is_known_user or reactions) and content_type != "html":
+            content_type = "html"
+            content = f"<div>{content}</div>"
+        parts = []
+        if not is_known_user:
+            sender_name = sender.display_name if sender is not None else None
+            if sender is None and old_msg.application_name is not None:
+                sender_name = old_msg.application_name
+            parts.append(
+                f"\n<p>-----</p>\n<b>Original message from: {sender_name}</b>\n<p>-----</p>\n"
+            )
+        if hosted_contents:
+            content = self.map_hosted_contents(request_body, content, hosted_contents)
+        parts.append(content)
+        if reactions:
+            # It is not yet possible to import reactions, they are listed below the message
+            parts.append("\n-----\n")
+            parts.extend(
+                f"<p>{self.reaction_user_name(reaction)}'s Reaktion: {reaction.reaction_type}</p>\n"
+                for reaction in reactions
+            )
+            parts.append("-----")
+        request_body["body"] = {
+            "contentType": content_type,
+            "content": self.body_pattern.sub(self._substitute, "".join(parts)),
+        }
+        for rule in self.rules:
+            rule(old_msg, request_body)
+        return request_body
+
+    def map_hosted_contents(
+        self, request_body: dict, content: str, hosted_contents: dict[str, HostedContent]
+    ) -> str:
+        # https://learn.microsoft.com/en-us/graph/api/chatmessage-post?view=graph-rest-1.0&tabs=http#example-4-send-a-message-with-inline-images
+        new_hosted_contents = []
+        for url in dict.fromkeys(HOSTED_CONTENT_PATTERN.findall(content)):
+            hosted_content = hosted_contents.get(url)
+            if hosted_content is None:
+                continue
+            temporary_id = str(len(new_hosted_contents) + 1)
+            content = content.replace(url, f"../hostedContents/{temporary_id}/$value")
+            new_hosted_contents.append(
+                {
+                    "@microsoft.graph.temporaryId": temporary_id,
+                    "contentBytes": base64.b64encode(hosted_content.read()).decode("ascii"),
+                    "contentType": hosted_content.content_type,
+                }
+            )
+        if new_hosted_contents:
+            request_body["hostedContents"] = new_hosted_contents
+        return content
+
+    def _substitute(self, match: re.Match) -> str:
+        replacement = self.substitutions[int(match.lastgroup.rsplit("_", 1)[1])][1]
+        return replacement if isinstance(replacement, str) else replacement(match)
+
+    def map_sender(self, sender: UserRecord | None) -> dict:
+        if sender is None or sender.id not in self.user_map:
+            # Posted in the name of the default user, the original sender is named in the body
+            return {
+                "user": {
+                    "id": self.default_user[0],
+                    "displayName": self.default_user[1],
+                    "userIdentityType": "aadUser",
+                    "tenantId": self.tenant_id,
+                }
+            }
+        return {"user": self.map_user(sender.to_json())}
+
+    def map_user(self, user: dict) -> dict:
+        # Copied, the user JSON may belong to the old message
+        user_id = user.get("id")
+        return {
+            **{name: value for name, value in user.items() if value is not None},
+            "id": self.user_map[user_id][1] if user_id in self.user_map else user_id,
+            "tenantId": self.tenant_id,
+        }
+
+    def map_mentions(self, mentions: tuple[dict, ...]) -> list[dict]:
+        new_mentions = []
+        for mention in mentions:
+            mentioned = mention.get("mentioned") or {}
+            if mentioned.get("user"):
+                mention = {
+                    **mention,
+                    "mentioned": {**mentioned, "user": self.map_user(mentioned["user"])},
+                }
+            new_mentions.append(mention)
+        return new_mentions
+
+    def map_attachments(self, attachments: tuple[dict, ...]) -> list[dict]:
+        new_attachments = []
+        for attachment in attachments:
+            if attachment.get("contentType") != "reference":
+                new_attachments.append(attachment)
+                continue
+            new_url = self.map_sharepoint_url(attachment.get("contentUrl") or "")
+            if new_url is None:
+                logger.warning("Didn't replace attachment: %s", attachment.get("contentUrl"))
+                continue
+            new_attachments.append(
+                {
+                    "contentType": "reference",
+                    "contentUrl": new_url,
+                    "id": attachment.get("id"),
+                    "name": attachment.get("name"),
+                }
+            )
+        return new_attachments
+
+    def map_sharepoint_url(self, url: str) -> str | None:
+        for length, prefixes in self.sharepoint_prefixes:
+            new_prefix = prefixes.get(url[:length])
+            if new_prefix is not None:
+                return new_prefix + url[length:]
+        return None
+
+    def reaction_user_name(self, reaction: ReactionRecord) -> str:
+        user = reaction.user
+        if user is None:
+            return "Unknown"
+        if user.id in self.user_map:
+            return self.user_map[user.id][0]
+        if user.display_name is not None:
+            return user.display_name
+        return user.id
@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+from collections import deque
+from collections.abc import AsyncIterator
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING
+
+from records import MessageRecord, PreparedMessage
+from transform import HostedContent, MessageTransformer, hosted_content_urls
+
+if TYPE_CHECKING:
+    from archive import ArchiveReader
+
+logger = logging.getLogger(__name__)
+
+# Threads of a channel handed to a worker process at a time
+RANGE_THREADS = 100
+
+# State of a worker process, set by _init_worker
+_transformer: MessageTransformer | None = None
+_hosted_contents: dict[str, HostedContent] = {}
+
+
+def _init_worker(transformer: MessageTransformer, hosted_contents: dict[str, HostedContent]):
+    global _transformer, _hosted_contents
+    _transformer = transformer
+    _hosted_contents = hosted_contents
+
+
+def _prepare(record: MessageRecord) -> PreparedMessage:
+    hosted_contents = {}
+    for url in hosted_content_urls(record):
+        if url in _hosted_contents:
+            hosted_contents[url] = _hosted_contents[url]
+        else:
+            logger.warning("Hosted content %s is not part of the archive", url)
+    request_body = _transformer.transform(record, hosted_contents)
+    return PreparedMessage(
+        record.id,
+        record.created_date_time,
+        json.dumps(request_body, ensure_ascii=False).encode("utf-8"),
+    )
+
+
+def _prepare_range(lines: list[bytes]) -> list[tuple[PreparedMessage, list[PreparedMessage]]]:
+    threads = []
+    for line in lines:
+        thread = json.loads(line)
+        threads.append(
+            (
+                _prepare(MessageRecord.from_json(thread["message"])),
+                [_prepare(MessageRecord.from_json(reply)) for reply in thread["replies"]],
+            )
+        )
+    return threads
+
+
+class TransformPool:
+    # Parses and transforms the threads of an archive in worker processes, so an import uses
+    # every core instead of one event loop. A channel is split into ranges of consecutive
+    # threads, prepared in parallel; the event loop only reads the compressed file and posts
+    # the request bodies. Inline images are read and encoded by the workers as well. The
+    # threads are handed to the channel's pipeline in the order of the archive, but posted like
+    # any other: the smallest queued thread first, thread_concurrency at a time (see
+    # pipeline.py). Imported messages keep their createdDateTime, so the posting order doesn't
+    # show in the new channel.
+    executor: ProcessPoolExecutor
+    workers: int
+    # Ranges of a channel prepared ahead of its import
+    prefetch: int
+
+    def __init__(
+        self,
+        transformer: MessageTransformer,
+        hosted_contents: dict[str, HostedContent],
+        workers: int | None = None,
+    ):
+        self.workers = workers or os.cpu_count() or 1
+        self.prefetch = self.workers
+        self.executor = ProcessPoolExecutor(
+            self.workers, initializer=_init_worker, initargs=(transformer, hosted_contents)
+        )
+
+    async def iter_threads(
+        self, archive: ArchiveReader, team_id: str, channel_id: str
+    ) -> AsyncIterator[tuple[PreparedMessage, list[PreparedMessage]]]:
+        loop = asyncio.get_running_loop()
+        ranges = deque()
+        try:
+            for lines in archive.iter_thread_ranges(team_id, channel_id, RANGE_THREADS):
+                ranges.append(loop.run_in_executor(self.executor, _prepare_range, lines))
+                if len(ranges) < self.prefetch:
+                    continue
+                for thread in await ranges.popleft():
+                    yield thread
+            while ranges:
+                for thread in await ranges.popleft():
+                    yield thread
+        finally:
+            for prepared in ranges:
+                prepared.cancel()
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
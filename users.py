@@ -0,0 +1,109 @@
+import json
+import logging
+import os
+
+from graph import Graph
+
+logger = logging.getLogger(__name__)
+
+USER_MAP_FILE = "user-map.json"
+
+# A rule matches users whose attribute (e.g. userPrincipalName or mail) is equal in both
+# tenants, compared case-insensitively after rewriting the mail domain of the old tenant
+MatchRule = tuple[str, dict[str, str]]
+
+
+class UserCache:
+    # The users of both tenants as read by the users delta query, with the delta links to
+    # refresh them. Kept in user-map.json between runs, so a refresh only reads the changes.
+    path: str
+    # Per tenant ("old", "new"): {"deltaLink": ..., "users": {id: {property: value}}}
+    tenants: dict[str, dict]
+
+    def __init__(self, path: str = USER_MAP_FILE):
+        self.path = path
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as cache_file:
+                self.tenants = json.load(cache_file)
+        else:
+            self.tenants = {}
+
+    async def refresh(self, tenant: str, graph: Graph) -> int:
+        # Returns the number of added, changed or removed users
+        cache = self.tenants.setdefault(tenant, {"deltaLink": None, "users": {}})
+        users = cache["users"]
+        delta_links = []
+        changes = 0
+        async for user in graph.iter_users_delta(cache["deltaLink"], delta_links.append):
+            changes += 1
+            if "@removed" in (user.additional_data or {}):
+                users.pop(user.id, None)
+                continue
+            # Changed users may come with only the changed properties
+            users.setdefault(user.id, {}).update(
+                {
+                    name: value
+                    for name, value in (
+                        ("displayName", user.display_name),
+                        ("userPrincipalName", user.user_principal_name),
+                        ("mail", user.mail),
+                    )
+                    if value is not None
+                }
+            )
+        if delta_links:
+            cache["deltaLink"] = delta_links[-1]
+        return changes
+
+    def save(self):
+        with open(self.path + ".tmp", "w", encoding="utf-8") as cache_file:
+            json.dump(self.tenants, cache_file, ensure_ascii=False)
+        os.replace(self.path + ".tmp", self.path)
+
+    def user_map(self, rules: list[MatchRule]) -> dict[str, tuple[str, str]]:
+        # Old user id to (display name in the old tenant, user id in the new tenant), in the
+        # format of the hand-written user_map of main.py
+        old_users = self.tenants.get("old", {}).get("users", {})
+        new_users = self.tenants.get("new", {}).get("users", {})
+        indexes = [index_users(new_users, attribute, {}) for attribute, _ in rules]
+        user_map = {}
+        for old_id, old_user in old_users.items():
+            for (attribute, domains), index in zip(rules, indexes):
+                new_id = index.get(match_key(old_user.get(attribute), domains))
+                if new_id is not None:
+                    user_map[old_id] = (old_user.get("displayName"), new_id)
+                    break
+        logger.info(
+            "%d of %d users of the old tenant matched in the new tenant",
+            len(user_map),
+            len(old_users),
+        )
+        return user_map
+
+
+def index_users(
+    users: dict[str, dict], attribute: str, domains: dict[str, str]
+) -> dict[str | None, str]:
+    # Keys shared by several users are left out, they can't be matched unambiguously
+    index = {}
+    ambiguous = set()
+    for user_id, user in users.items():
+        key = match_key(user.get(attribute), domains)
+        if key is None:
+            continue
+        if key in index:
+            ambiguous.add(key)
+        index[key] = user_id
+    for key in ambiguous:
+        logger.warning("%s %s belongs to several users, not matched", attribute, key)
+        del index[key]
+    return index
+
+
+def match_key(value: str | None, domains: dict[str, str]) -> str | None:
+    if not value:
+        return None
+    local_part, at, domain = value.lower().rpartition("@")
+    if not at:
+        return domain
+    return f"{local_part}@{domains.get(domain, domain)}"
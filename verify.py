@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import html
+import logging
+import re
+from collections.abc import AsyncIterator
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import TYPE_CHECKING
+
+from archive import ArchiveReader
+from graph import Graph
+from journal import MigrationJournal
+from records import MessageRecord
+from transform import MessageTransformer
+
+if TYPE_CHECKING:
+    from msgraph.generated.models.channel import Channel
+
+logger = logging.getLogger(__name__)
+
+# Discrepancies logged one by one per channel, the others are only counted
+LOGGED_DISCREPANCIES = 10
+
+EMOJI_PATTERN = re.compile(r'<emoji[^>]*\balt="([^"]*)"[^>]*>(?:</emoji>)?')
+TAG_PATTERN = re.compile(r"<[^>]+>")
+
+
+def fingerprint(content: str, attachments: list[dict] | tuple[dict, ...]) -> str:
+    # Hash of the text (markup, whitespace and image URLs don't count) and of the names of the
+    # referenced files, as the new tenant may render the same message differently
+    text = html.unescape(TAG_PATTERN.sub(" ", EMOJI_PATTERN.sub(r"\1", content)))
+    names = sorted(
+        attachment.get("name") or ""
+        for attachment in attachments
+        if attachment.get("contentType") == "reference"
+    )
+    return hashlib.sha256("\0".join([" ".join(text.split()), *names]).encode()).hexdigest()
+
+
+@dataclass
+class ThreadDigest:
+    # All that is kept of a thread until its counterpart arrives
+    fingerprint: str
+    replies: dict[datetime, list[str]]
+
+
+@dataclass
+class ChannelReport:
+    team_id: str
+    display_name: str
+    messages: int = 0
+    replies: int = 0
+    # Per kind of discrepancy ("missing", "duplicated", "altered", "unexpected"), messages and
+    # replies counted separately
+    messages_by_kind: dict[str, int] = field(default_factory=dict)
+    replies_by_kind: dict[str, int] = field(default_factory=dict)
+    logged: int = 0
+
+    def record(self, kind: str, is_reply: bool, created: datetime, count: int = 1):
+        counts = self.replies_by_kind if is_reply else self.messages_by_kind
+        counts[kind] = counts.get(kind, 0) + count
+        if self.logged < LOGGED_DISCREPANCIES:
+            self.logged += 1
+            logger.warning(
+                "%s / %s: %s %s created %s",
+                self.team_id,
+                self.display_name,
+                kind,
+                "reply" if is_reply else "message",
+                created.isoformat(),
+            )
+
+    @property
+    def is_complete(self) -> bool:
+        return not self.messages_by_kind and not self.replies_by_kind
+
+
+class ChannelVerification:
+    # Joins the threads of the old and the new channel on the createdDateTime of their message
+    # (kept by the migration) while both are read. Only the digests of threads whose
+    # counterpart has not arrived yet are held.
+    transformer: MessageTransformer
+    report: ChannelReport
+    pending: dict[str, dict[datetime, list[ThreadDigest]]]
+    matched: set[datetime]
+
+    def __init__(self, transformer: MessageTransformer, report: ChannelReport):
+        self.transformer = transformer
+        self.report = report
+        self.pending = {"old": {}, "new": {}}
+        self.matched = set()
+
+    def digest(
+        self, side: str, message: MessageRecord, replies: list[MessageRecord]
+    ) -> ThreadDigest:
+        reply_digests = {}
+        for reply in replies:
+            reply_digests.setdefault(reply.created_date_time, []).append(
+                self.fingerprint(side, reply)
+            )
+        return ThreadDigest(self.fingerprint(side, message), reply_digests)
+
+    def fingerprint(self, side: str, message: MessageRecord) -> str:
+        # The old side is compared as the migration would have sent it
+        if side == "old":
+            request_body = self.transformer.transform(message)
+            return fingerprint(request_body["body"]["content"], request_body["attachments"])
+        return fingerprint(message.body_content, message.attachments)
+
+    async def consume(
+        self, side: str, threads: AsyncIterator[tuple[MessageRecord, list[MessageRecord]]]
+    ):
+        other_side = "new" if side == "old" else "old"
+        async for message, replies in threads:
+            if side == "old":
+                self.report.messages += 1
+                self.report.replies += len(replies)
+            created = message.created_date_time
+            digest = self.digest(side, message, replies)
+            counterparts = self.pending[other_side].get(created)
+            if not counterparts:
+                self.pending[side].setdefault(created, []).append(digest)
+                continue
+            counterpart = counterparts.pop()
+            if not counterparts:
+                del self.pending[other_side][created]
+            self.matched.add(created)
+            if side == "old":
+                self.compare(created, digest, counterpart)
+            else:
+                self.compare(created, counterpart, digest)
+
+    def compare(self, created: datetime, old: ThreadDigest, new: ThreadDigest):
+        if old.fingerprint != new.fingerprint:
+            self.report.record("altered", False, created)
+        for reply_created, old_fingerprints in old.replies.items():
+            new_fingerprints = new.replies.pop(reply_created, [])
+            for kind, count in (
+                ("missing", len(old_fingerprints) - len(new_fingerprints)),
+                ("duplicated", len(new_fingerprints) - len(old_fingerprints)),
+            ):
+                if count > 0:
+                    self.report.record(kind, True, reply_created, count)
+            if len(old_fingerprints) == len(new_fingerprints) and sorted(
+                old_fingerprints
+            ) != sorted(new_fingerprints):
+                self.report.record("altered", True, reply_created)
+        for reply_created, new_fingerprints in new.replies.items():
+            self.report.record("unexpected", True, reply_created, len(new_fingerprints))
+
+    def finish(self):
+        # Whatever is left has no counterpart
+        for created, digests in self.pending["old"].items():
+            for digest in digests:
+                self.report.record("missing", False, created)
+                replies = sum(len(fingerprints) for fingerprints in digest.replies.values())
+                if replies:
+                    self.report.record("missing", True, created, replies)
+        for created, digests in self.pending["new"].items():
+            kind = "duplicated" if created in self.matched else "unexpected"
+            self.report.record(kind, False, created, len(digests))
+
+
+async def verify_team(
+    old_teams: Graph | ArchiveReader,
+    new_teams: Graph,
+    old_team_id: str,
+    new_team_id: str,
+    channel_names: dict[str, set[str]],
+    journal: MigrationJournal,
+    channel_slots: asyncio.Semaphore,
+) -> list[ChannelReport]:
+    channels = await old_teams.list_all_channels(old_team_id)
+    return await asyncio.gather(
+        *(
+            verify_channel(
+                old_teams, new_teams, old_team_id, new_team_id, channel, journal, channel_slots
+            )
+            for channel in channels
+            if channel.display_name in channel_names[old_team_id]
+        )
+    )
+
+
+async def verify_channel(
+    old_teams: Graph | ArchiveReader,
+    new_teams: Graph,
+    old_team_id: str,
+    new_team_id: str,
+    channel: Channel,
+    journal: MigrationJournal,
+    channel_slots: asyncio.Semaphore,
+) -> ChannelReport:
+    report = ChannelReport(old_team_id, channel.display_name)
+    new_channel_id = journal.get_channel(channel.id)[0]
+    if new_channel_id is None:
+        logger.warning("%s / %s: not migrated yet", old_team_id, channel.display_name)
+        report.messages_by_kind["not migrated"] = 1
+        return report
+    async with channel_slots:
+        verification = ChannelVerification(new_teams.transformer, report)
+        # Both channels are read at the same time, each page by page
+        await asyncio.gather(
+            verification.consume("old", old_teams.iter_threads(old_team_id, channel.id)),
+            verification.consume("new", new_teams.iter_threads(new_team_id, new_channel_id)),
+        )
+        verification.finish()
+    logger.info(
+        "verified channel %s: %d messages, %d replies, %s",
+        channel.display_name,
+        report.messages,
+        report.replies,
+        "complete" if report.is_complete else "DISCREPANCIES FOUND",
+    )
+    return report
+
+
+def report(channel_reports: list[ChannelReport]):
+    totals = {"messages": {}, "replies": {}}
+    for channel_report in channel_reports:
+        for name, counts in (
+            ("messages", channel_report.messages_by_kind),
+            ("replies", channel_report.replies_by_kind),
+        ):
+            for kind, count in counts.items():
+                totals[name][kind] = totals[name].get(kind, 0) + count
+        if not channel_report.is_complete:
+            logger.warning(
+                "%s / %s: messages %s, replies %s",
+                channel_report.team_id,
+                channel_report.display_name,
+                format_counts(channel_report.messages_by_kind),
+                format_counts(channel_report.replies_by_kind),
+            )
+    logger.info(
+        "verified %d channels with %d messages and %d replies, %d channels with discrepancies: "
+        "messages %s, replies %s",
+        len(channel_reports),
+        sum(channel_report.messages for channel_report in channel_reports),
+        sum(channel_report.replies for channel_report in channel_reports),
+        sum(not channel_report.is_complete for channel_report in channel_reports),
+        format_counts(totals["messages"]),
+        format_counts(totals["replies"]),
+    )
+
+
+def format_counts(counts: dict[str, int]) -> str:
+    if not counts:
+        return "none"
+    return ", ".join(f"{count} {kind}" for kind, count in sorted(counts.items()))